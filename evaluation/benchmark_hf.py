@@ -0,0 +1,100 @@
+import argparse
+import sys
+import time
+import gc
+import pprint
+import numpy as np
+import torch
+from tqdm import tqdm
+
+sys.path.append("..")
+
+from utils import read_json, write_json
+from evaluate_hf import ModelWrapper, MODELS_MAP, PRECISIONS, pack_batches
+from evaluate_and_report import DATA_PATHS
+
+def load_subset(template, tasks, num_samples):
+    """Takes the first num_samples instances of every task, so that all models and precisions see the same prompts."""
+    samples = []
+
+    for task, datapath in DATA_PATHS:
+        if task in tasks:
+            samples.extend(read_json(datapath.format(template=template))[:num_samples])
+
+    return samples
+
+def score_subset(model, prompts, batch_size, max_batch_tokens=None):
+    decisions = [None] * len(prompts)
+    start = time.perf_counter()
+    model.set_shared_prefix(prompts)
+
+    for batch in tqdm(pack_batches(model.get_prompt_lengths(prompts), batch_size, max_batch_tokens), desc=f"{model.get_model_name()} {model.precision}"):
+        for index, answer in zip(batch, model.score_answers([prompts[index] for index in batch])):
+            decisions[index] = answer["highest_proba"]
+
+    return decisions, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="+", default=list(MODELS_MAP), help="Models to benchmark")
+    parser.add_argument("--precisions", type=str, nargs="+", choices=PRECISIONS, default=["bf16", "int8-dynamic"], help="Precisions to compare against fp32")
+    parser.add_argument("--template", type=str, default="bcq", help="Dataset template to use")
+    parser.add_argument("--tasks", type=str, nargs="+", default=[task for task, _ in DATA_PATHS], help="Tasks to take samples from")
+    parser.add_argument("--num-samples", type=int, default=50, help="Number of samples taken from the start of every task")
+    parser.add_argument("--batch-size", type=int, default=8, help="Maximum number of prompts scored together")
+    parser.add_argument("--max-batch-tokens", type=int, default=None, help="Maximum number of padded prompt tokens in a batch")
+    parser.add_argument("--num-threads", type=int, default=None, help="Number of torch threads (defaults to the torch setting)")
+    parser.add_argument("--output-path", type=str, default=None, help="Path to write the benchmark results to in json")
+
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    samples = load_subset(args.template, args.tasks, args.num_samples)
+    prompts = [sample["prompt"]+'.' for sample in samples]
+    references = np.array([sample["answer"].strip().lower() for sample in samples])
+    print(f"Benchmarking on {len(prompts)} samples with {torch.get_num_threads()} threads")
+
+    results = {
+        "metadata": {
+            "template": args.template,
+            "tasks": args.tasks,
+            "num_samples": len(prompts),
+            "batch_size": args.batch_size,
+            "max_batch_tokens": args.max_batch_tokens,
+            "num_threads": torch.get_num_threads()
+        },
+        "models": {}
+    }
+
+    for model_name in args.models:
+        results["models"][model_name] = {}
+        reference_decisions = None
+
+        # fp32 always runs first, the other precisions are compared to its decisions
+        for precision in ["fp32"] + [precision for precision in args.precisions if precision != "fp32"]:
+            model = ModelWrapper(model_name, precision=precision)
+            decisions, elapsed = score_subset(model, prompts, args.batch_size, args.max_batch_tokens)
+            decisions = np.array(decisions)
+
+            if reference_decisions is None:
+                reference_decisions = decisions
+
+            results["models"][model_name][precision] = {
+                "samples_per_second": len(prompts) / elapsed,
+                "seconds": elapsed,
+                "agreement_with_fp32": float(np.mean(decisions == reference_decisions)),
+                "accuracy": float(np.mean(decisions == references))
+            }
+
+            del model
+            gc.collect()
+
+        pprint.pprint({model_name: results["models"][model_name]})
+
+    if args.output_path is not None:
+        write_json(results, args.output_path)
+
+if __name__ == "__main__":
+    main()
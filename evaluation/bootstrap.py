@@ -0,0 +1,82 @@
+import numpy as np
+from statistics import NormalDist
+from metrics_engine import get_cells, macro_f1, accuracy, precision, recall
+
+CONFUSION_METRICS = {"macro_f1": macro_f1, "accuracy": accuracy, "precision": precision, "recall": recall}
+
+def get_cluster_counts(arrays):
+    """Confusion counts of every exact-match group, overall and per dimension, with whether all samples of the group are correct."""
+    predictions, references, groups, membership = arrays["predictions"], arrays["references"], arrays["groups"], arrays["membership"]
+    num_groups = int(groups.max()) + 1
+    cells = get_cells(predictions, references)
+    confusions = np.zeros((num_groups, 4))
+    np.add.at(confusions, groups, cells)
+    dimension_confusions = np.zeros((num_groups, membership.shape[1], 4))
+    np.add.at(dimension_confusions, groups, membership[:, :, None] * cells[:, None, :])
+    correct = np.bincount(groups, weights=predictions != references, minlength=num_groups) == 0
+    return confusions, dimension_confusions, correct.astype(float)
+
+def get_resample_weights(rng, num_groups, num_resamples):
+    # every row counts how often each group is drawn when the groups are resampled with replacement
+    indices = rng.integers(0, num_groups, size=(num_resamples, num_groups))
+    offsets = np.arange(num_resamples)[:, None] * num_groups
+    return np.bincount((indices + offsets).ravel(), minlength=num_resamples * num_groups).reshape(num_resamples, num_groups).astype(float)
+
+def get_interval(values, confidence):
+    alpha = (1 - confidence) / 2
+    return {"low": float(np.quantile(values, alpha)), "high": float(np.quantile(values, 1 - alpha)), "se": float(np.std(values, ddof=1))}
+
+def normal_interval(estimate, se, confidence):
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    return {"low": estimate - z * se, "high": estimate + z * se, "se": se}
+
+def bootstrap_metrics(arrays, dimension_names, num_resamples=10000, confidence=0.95, seed=None, chunk_size=500):
+    """Percentile intervals and standard errors of every metric, resampling whole exact-match groups for all resamples of a chunk at once."""
+    confusions, dimension_confusions, correct = get_cluster_counts(arrays)
+    num_groups = len(correct)
+    # dimensions without knowledge items have no score to bound
+    dimensions = np.flatnonzero(dimension_confusions.sum(axis=(0, 2)) > 0)
+    dimension_confusions = dimension_confusions[:, dimensions]
+    rng = np.random.default_rng(seed)
+    values = {"exact_match": [], **{name: [] for name in CONFUSION_METRICS}, "dimensions": []}
+
+    for start in range(0, num_resamples, chunk_size):
+        weights = get_resample_weights(rng, num_groups, min(chunk_size, num_resamples - start))
+        resampled_confusions = weights @ confusions
+        values["exact_match"].append(weights @ correct / num_groups)
+
+        for name, metric in CONFUSION_METRICS.items():
+            values[name].append(metric(resampled_confusions))
+
+        values["dimensions"].append(macro_f1(np.einsum("bg,gdk->bdk", weights, dimension_confusions)))
+
+    ci = {"confidence": confidence, "num_resamples": num_resamples, "seed": seed}
+
+    for name in ["exact_match", *CONFUSION_METRICS]:
+        ci[name] = get_interval(np.concatenate(values[name]), confidence)
+
+    dimension_values = np.concatenate(values["dimensions"])
+    ci["dimensions"] = {dimension_names[dimension]: get_interval(dimension_values[:, index], confidence) for index, dimension in enumerate(dimensions)}
+
+    return ci
+
+def aggregate_intervals(cis, estimates, confidence, independent=True):
+    """Normal intervals of averaged metrics from the standard errors of the averaged intervals.
+
+    Metrics of different tasks are independent, so the standard error of their mean shrinks with their number.
+    Runs on the same data are not, so their mean keeps the average standard error.
+    """
+    aggregated = {}
+
+    for name, estimate in estimates.items():
+        if isinstance(estimate, dict):
+            intervals = {key: aggregate_intervals([ci[name] for ci in cis], {key: value}, confidence, independent)[key] for key, value in estimate.items() if all(name in ci and key in ci[name] for ci in cis)}
+
+            if intervals:
+                aggregated[name] = intervals
+        elif all(name in ci for ci in cis):
+            ses = np.array([ci[name]["se"] for ci in cis])
+            se = np.sqrt(np.sum(ses ** 2)) / len(ses) if independent else np.mean(ses)
+            aggregated[name] = normal_interval(estimate, float(se), confidence)
+
+    return aggregated
@@ -0,0 +1,36 @@
+class CostBudget():
+    """Hard cap on the spend of a run, checked before every request is dispatched.
+
+    Each request reserves its projected cost up front and settles it with the real usage once it
+    finishes, so requests in flight are accounted for when deciding whether to dispatch the next one.
+    The budget can be shared by several models, each priced with its own entry in model_costs.
+    """
+
+    def __init__(self, max_cost, model_costs):
+        self.max_cost = max_cost
+        self.model_costs = model_costs
+        self.spent = 0
+        self.reserved = 0
+        self.exhausted = False
+
+    def estimate(self, model, prompt_tokens, completion_tokens):
+        return prompt_tokens * self.model_costs[model]["input"] + completion_tokens * self.model_costs[model]["output"]
+
+    def reserve(self, cost):
+        if self.exhausted or self.spent + self.reserved + cost > self.max_cost:
+            self.exhausted = True
+            return False
+
+        self.reserved += cost
+        return True
+
+    def settle(self, model, reserved_cost, usage):
+        self.reserved -= reserved_cost
+        self.spent += self.estimate(model, usage["prompt_tokens"], usage["completion_tokens"])
+
+    def stats(self):
+        return {
+            "max_cost": self.max_cost,
+            "spent": self.spent,
+            "exhausted": self.exhausted
+        }
@@ -0,0 +1,51 @@
+import os
+import json
+
+CONTENT_FREE_INPUTS = ["N/A", "[MASK]", ""]
+
+def get_content_free_prompts(prompt, content_free_inputs=CONTENT_FREE_INPUTS):
+    """Replaces every field of the final example of a prepared prompt with each content-free input."""
+    index = prompt.rfind("Example ")
+
+    if index < 0:
+        raise ValueError("Prompt has no final example to build content-free prompts from.")
+
+    head, final_shot = prompt[:index], prompt[index:]
+    blocks = final_shot.split("\n\n")
+    title, answer = blocks[0], blocks[-1]
+    headers = []
+
+    # fields are "Header:\ncontent" blocks, blocks without such a header continue the content of the previous field
+    for block in blocks[1:-1]:
+        header = block.split("\n")[0]
+
+        if header.endswith(":") and "\n" in block:
+            headers.append(header)
+
+    return [head + "\n\n".join([title] + [f"{header}\n{content_free_input}" for header in headers] + [answer]) for content_free_input in content_free_inputs]
+
+def get_calibration_path(calibration_dir, model, template):
+    return os.path.join(calibration_dir, model, f"{template}.json")
+
+def load_biases(path, precision, content_free_inputs=CONTENT_FREE_INPUTS):
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r") as f:
+        calibration = json.load(f)
+
+    # biases measured with other weights or other content-free inputs are stale
+    if calibration["precision"] != precision or calibration["content_free_inputs"] != content_free_inputs:
+        return None
+
+    return calibration["biases"]
+
+def save_biases(path, biases, precision, content_free_inputs=CONTENT_FREE_INPUTS):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + f".tmp{os.getpid()}"
+
+    with open(tmp_path, "w") as f:
+        json.dump({"biases": biases, "precision": precision, "content_free_inputs": content_free_inputs}, f, indent=4)
+
+    # workers of a sharded run may calibrate at the same time, so the file is replaced atomically
+    os.replace(tmp_path, path)
@@ -28,6 +28,20 @@ MODEL_LATEX_MAP = {
     "gpt-4": "GPT-4"
 }
 
+def format_score(run_metrics, metric, args, run_file):
+    score = f"{run_metrics[metric]*100:.1f}"
+
+    if not args.ci:
+        return score
+
+    if "ci" not in run_metrics or metric not in run_metrics["ci"]:
+        raise ValueError(f"No confidence interval of {metric} in {run_file}, run report_metrics.py with --num-resamples.")
+
+    # percentile intervals need not be symmetric, so their half-width is shown
+    interval = run_metrics["ci"][metric]
+    half_width = (interval["high"] - interval["low"]) / 2 * 100
+    return f"{score}$\\pm${half_width:.1f}" if args.output_format == "latex" else f"{score} ± {half_width:.1f}"
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--models", type=str, nargs="+", default=MODELS, choices=MODELS, help="Models to get results from.")
@@ -36,6 +50,7 @@ def main():
     parser.add_argument("--output-format", type=str, choices=["csv", "latex"], default="csv", help="Format to write results in.")
     parser.add_argument("--metrics", type=str, nargs="+", default=["macro_f1", "exact_match"], help="Metrics to write to file.")
     parser.add_argument("--base-outputs-dir", type=str, default="outputs", help="Base directory to look for runs in.")
+    parser.add_argument("--ci", action="store_true", default=False, help="Follow every score with the half-width of its confidence interval.")
 
     args = parser.parse_args()
 
@@ -75,11 +90,11 @@ def main():
                     with_mt_metrics = []
                     
                     for metric in args.metrics:
-                        non_mt_metrics.append(run_metrics[f"non_mt_{metric}"])
-                        with_mt_metrics.append(run_metrics[metric])
+                        non_mt_metrics.append(format_score(run_metrics, f"non_mt_{metric}", args, run_file))
+                        with_mt_metrics.append(format_score(run_metrics, metric, args, run_file))
 
-                    model_metrics["non_mt_crow_score"] = " / ".join([f"{m*100:.1f}" for m in non_mt_metrics])
-                    model_metrics["crow_score"] = " / ".join([f"{m*100:.1f}" for m in with_mt_metrics])
+                    model_metrics["non_mt_crow_score"] = " / ".join(non_mt_metrics)
+                    model_metrics["crow_score"] = " / ".join(with_mt_metrics)
                 elif "metrics" in run_file:
                     task = [t for t in TASKS if t in run_file][0]
                     run_metrics = read_json(run_file)
@@ -89,9 +104,9 @@ def main():
                         if metric not in run_metrics:
                             raise ValueError(f"Metric {metric} not found in {run_file}.")
 
-                        task_metrics.append(run_metrics[metric])
+                        task_metrics.append(format_score(run_metrics, metric, args, run_file))
                     
-                    model_metrics[task] = " / ".join([f"{m*100:.1f}" for m in task_metrics])
+                    model_metrics[task] = " / ".join(task_metrics)
         
             metrics.append(model_metrics)
     
@@ -1,6 +1,8 @@
 import argparse
 import subprocess
 
+from model_client import wait_for_server
+
 DATA_PATHS = [
     ("dialogue", "dialogue/data/full_data/dialogue_eval_llm_{template}.json"),
     ("intent", "intent/data/full_data/intent_eval_llm_{template}.json"),
@@ -17,42 +19,134 @@ def get_script_name(model):
     if model in ["random", "majority"]:
         return "./evaluate_baseline.py"
     
-    if model in ["gpt-4", "text-davinci-003"]:
+    if model in ["gpt-3.5-turbo", "gpt-4", "text-davinci-003"]:
         return "./evaluate_gpt.py"
     
     return "./evaluate_hf.py"
 
+# evaluate_hf options that configure the served model, which the server has to load with it
+SERVER_OPTIONS = ["--draft-model", "--weights-cache-dir"]
+
+# evaluate_hf options that load the model in the evaluation process, which a model server replaces
+NO_SERVER_OPTIONS = ["--num-workers"]
+
+def get_options(arguments, names):
+    """Options of arguments among names with their values, as given on the command line."""
+    options = []
+
+    for index, argument in enumerate(arguments):
+        name = argument.split("=")[0]
+
+        if name in names:
+            options += [argument] if "=" in argument else arguments[index:index + 2]
+
+    return options
+
 def run_python_script(script_name, arguments):
     subprocess.run(["python", script_name] + arguments)
 
+def start_model_server(model, port, precision=None, server_options=()):
+    arguments = ["--model", model, "--port", str(port)] + list(server_options)
+
+    if precision is not None:
+        arguments += ["--precision", precision]
+
+    print(f"Starting model server for {model}")
+    process = subprocess.Popen(["python", "./model_server.py"] + arguments)
+
+    try:
+        client = wait_for_server(f"http://127.0.0.1:{port}", process=process)
+    except BaseException:
+        process.terminate()
+        raise
+
+    return process, client
+
+def stop_model_server(process, client):
+    print("Stopping model server")
+
+    try:
+        client.shutdown()
+        process.wait(timeout=60)
+    except Exception:
+        process.terminate()
+        process.wait()
+
+def report_metrics(model, output_dir):
+    print(f"Reporting metrics for {model}")
+    run_python_script("./report_metrics.py", ["--results-path", output_dir])
+    run_python_script("./report_agg_metrics_across_tasks.py", ["--model", model, "--results-dir", output_dir])
+
 def main():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("--template", type=str, default="bcq", help="Dataset template to use")
     parser.add_argument("--model", type=str, default="random", help="Model to use for evaluation")
+    parser.add_argument("--models", type=str, nargs="+", default=None, help="Models to evaluate, GPT models are fanned out from a single process per task (overrides --model)")
     parser.add_argument("--run-name", type=str, default="run1", help="Run name for outputs")
     parser.add_argument("--tasks", type=str, nargs="+", default=["dialogue", "intent", "safety", "stance", "summarization", "mt_en_de", "mt_en_fr", "mt_en_ru", "mt_zh_en"], help="Tasks to evaluate on")
+    parser.add_argument("--no-server", action="store_true", default=False, help="Load Hugging Face models once per task instead of serving them from one model server")
+    parser.add_argument("--server-port", type=int, default=8765, help="Local port of the model server")
+    parser.add_argument("--precision", type=str, default=None, help="Weights precision of Hugging Face models")
     parser.add_argument("rest", nargs=argparse.REMAINDER, help="Other script arguments") # invoke with -- in the beginning
 
     args = parser.parse_args()
 
-    script_name = get_script_name(args.model)
+    models = args.models if args.models is not None else [args.model]
+    hf_models = [model for model in models if get_script_name(model) == "./evaluate_hf.py"]
+    no_server_options = get_options(args.rest, NO_SERVER_OPTIONS)
+
+    if hf_models and not args.no_server and no_server_options:
+        parser.error(f"{' '.join(no_server_options)} loads the model in evaluate_hf.py, which the model server replaces. Use it with --no-server.")
 
-    output_dir = f"outputs/{args.model}/{args.run_name}"
+    gpt_models = [model for model in models if get_script_name(model) == "./evaluate_gpt.py"]
+    other_models = [model for model in models if model not in gpt_models]
 
-    for task, datapath in DATA_PATHS:
-        if task in args.tasks:
-            datapath = datapath.format(template=args.template)
-            print(f"Running {script_name} for {datapath}")
-            base_args = ["--datapath", datapath, "--model", args.model, "--output-dir", output_dir]
-            run_python_script(script_name, base_args + args.rest[1:]) # first element is --
+    # GPT models share one data load, cache and scheduler per task, each writing to its own output dir
+    if len(gpt_models) > 1:
+        output_dir = f"outputs/{{model}}/{args.run_name}"
+
+        for task, datapath in DATA_PATHS:
+            if task in args.tasks:
+                datapath = datapath.format(template=args.template)
+                print(f"Running ./evaluate_gpt.py for {datapath} with {', '.join(gpt_models)}")
+                base_args = ["--datapath", datapath, "--models"] + gpt_models + ["--output-dir", output_dir]
+                run_python_script("./evaluate_gpt.py", base_args + args.rest[1:]) # first element is --
+        
+        for model in gpt_models:
+            report_metrics(model, output_dir.format(model=model))
+    else:
+        other_models = models
+
+    for model in other_models:
+        script_name = get_script_name(model)
+        output_dir = f"outputs/{model}/{args.run_name}"
+        server = None
+        model_args = []
+
+        if script_name == "./evaluate_hf.py":
+            # the model is loaded once by the server instead of once per task
+            if args.no_server:
+                model_args = ["--precision", args.precision] if args.precision is not None else []
+            else:
+                # evaluate_hf keeps these options too, to check the server was started with them
+                server = start_model_server(model, args.server_port, precision=args.precision, server_options=get_options(args.rest, SERVER_OPTIONS))
+                model_args = ["--server-url", f"http://127.0.0.1:{args.server_port}"]
+
+        try:
+            for task, datapath in DATA_PATHS:
+                if task in args.tasks:
+                    datapath = datapath.format(template=args.template)
+                    print(f"Running {script_name} for {datapath}")
+                    base_args = ["--datapath", datapath, "--model", model, "--output-dir", output_dir] + model_args
+                    run_python_script(script_name, base_args + args.rest[1:]) # first element is --
+        finally:
+            if server is not None:
+                stop_model_server(*server)
     
-    # Report metrics
-    print("Reporting metrics")
-    run_python_script("./report_metrics.py", ["--results-path", output_dir])
-    run_python_script("./report_agg_metrics_across_tasks.py", ["--model", args.model, "--results-dir", output_dir])
+        report_metrics(model, output_dir)
 
     print("Done")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import openai
 import time
 from openai.error import OpenAIError
@@ -11,10 +12,20 @@ import pathlib
 import uuid
 import sys
 import re
+import pprint
+import random
+import copy
+from collections import Counter
 
 sys.path.append("..")
 
-from utils import read_json, write_json, generate_unique_id, MODEL_COSTS
+from utils import read_json, write_json, generate_unique_id, num_tokens_from_string, num_tokens_from_strings, MODEL_COSTS, MODEL_RATE_LIMITS
+from rate_limiter import RateLimiter
+from journal import RunJournal, get_journal_path, get_output_path
+from response_cache import ResponseCache, get_cache_key
+from budget import CostBudget
+from sequential import SequentialStopper, stratified_group_order
+from config import TASKS
 
 #openai.api_key = args.os.getenv("OPENAI_API_KEY")
 
@@ -71,162 +82,594 @@ def text_completion(prompt, model="text-davinci-003", return_text=True, return_u
             time.sleep(60)
             continue
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--datapath", type=str, help="Path to evaluation data in json", required=True)
-    parser.add_argument("--openai-key", type=str, help="OpenAI API Key", required=True)
-    parser.add_argument("--model", type=str, help="Model to use for evaluation", default="gpt-3.5-turbo")
-    parser.add_argument("--temperature", type=float, help="Temperature for generation", default=0.3)
-    parser.add_argument("--max-tokens", type=int, help="Max tokens for generation", default=40)
-    parser.add_argument("--top-p", type=float, help="Top p for generation", default=1)
-    parser.add_argument("--frequency-penalty", type=float, help="Frequency penalty for generation", default=0)
-    parser.add_argument("--presence-penalty", type=float, help="Presence penalty for generation", default=0)
-    parser.add_argument("--output-dir", type=str, help="Output directory for evaluation results", default="outputs")
-    parser.add_argument("--num-samples", type=int, help="Number of samples to evaluate", default=0)
-    parser.add_argument("--ignore-path", type=str, help="Path to already evaluated data", default=None)
+async def async_chat_completion(messages, model="gpt-3.5-turbo", model_args=None):
+    if model_args is None:
+        model_args = {}
+
+    while True:
+        try:
+            response = await openai.ChatCompletion.acreate(model=model, messages=messages, **model_args)
+            return response["choices"][0]["message"]["content"].strip(), response["usage"]
+        except OpenAIError as e:
+            print("OpenAI error. Waiting for 1 minute.")
+            await asyncio.sleep(60)
+            continue
+
+async def async_text_completion(prompt, model="text-davinci-003", model_args=None):
+    if model_args is None:
+        model_args = {}
+
+    while True:
+        try:
+            response = await openai.Completion.acreate(model=model, prompt=prompt, **model_args)
+            return response["choices"][0]["text"].strip(), response["usage"]
+        except OpenAIError as e:
+            print("OpenAI error. Waiting for 1 minute.")
+            await asyncio.sleep(60)
+            continue
+
+def complete(sample, model, model_args):
+    if model in CHAT_COMPLETION_MODELS:
+        return chat_completion([{"role": "user", "content": sample["prompt"].strip()}], model=model, return_text=True, return_usage=True, model_args=model_args)
     
-    args = parser.parse_args()
-    openai.api_key = args.openai_key 
-    data = read_json(args.datapath)
+    if model in TEXT_COMPLETION_MODELS:
+        return text_completion(sample["prompt"].strip(), model=model, return_text=True, return_usage=True, model_args=model_args)
     
-    ignore_map = {}
+    raise ValueError(f"Model {model} not supported for evaluation.")
 
-    if args.ignore_path is not None:
-        ignore_data = read_json(args.ignore_path)
-        
-        for sample in ignore_data["data"]:
-            ignore_map[sample["instance_id"]] = sample
+async def async_complete(sample, model, model_args):
+    if model in CHAT_COMPLETION_MODELS:
+        return await async_chat_completion([{"role": "user", "content": sample["prompt"].strip()}], model=model, model_args=model_args)
+    
+    if model in TEXT_COMPLETION_MODELS:
+        return await async_text_completion(sample["prompt"].strip(), model=model, model_args=model_args)
+    
+    raise ValueError(f"Model {model} not supported for evaluation.")
 
-    if args.num_samples > 0:
-        data = data[:int(args.num_samples)]
+def get_cached_response(cache, sample, model, model_args):
+    if cache is None:
+        return None
 
-    predictions = []
-    references = []
-
-    outputs = {
-        "metadata": {
-            "datapath": args.datapath,
-            "model": args.model,
-            "temperature": args.temperature,
-            "max_tokens": args.max_tokens,
-            "top_p": args.top_p,
-            "frequency_penalty": args.frequency_penalty,
-            "presence_penalty": args.presence_penalty
-        },
-        "metrics": {
-            "accuracy": 0,
-            "precision": 0,
-            "recall": 0,
-            "f1": 0,
-            "usage": {
-                "prompt_tokens": 0,
-                "completion_tokens": 0,
-                "total_tokens": 0
-            },
-            "cost": {
-                "input": 0,
-                "output": 0,
-                "total": 0
+    cached = cache.get("openai", model, sample["prompt"].strip(), model_args)
+
+    if cached is None:
+        return None
+
+    return cached["response"], cached["usage"]
+
+def cache_response(cache, sample, model, model_args, response, usage):
+    if cache is not None:
+        cache.put("openai", model, sample["prompt"].strip(), model_args, {"response": response, "usage": usage})
+
+def estimate_request_tokens(sample, model, model_args):
+    # reserve the whole completion budget up front, the limiter and budget are settled with the real usage afterwards
+    return num_tokens_from_string(sample["prompt"].strip(), model), model_args.get("max_tokens", 0)
+
+def plan_usage(samples, model, model_args, task, completion_tokens=None, num_threads=8):
+    if completion_tokens is None:
+        completion_tokens = model_args["max_tokens"]
+
+    prompt_tokens = num_tokens_from_strings([sample["prompt"].strip() for sample in samples], model, num_threads=num_threads)
+    plan = {}
+
+    for sample, num_prompt_tokens in zip(samples, prompt_tokens):
+        if sample["type"] not in plan:
+            plan[sample["type"]] = {
+                "task": task,
+                "template": sample["type"],
+                "num_requests": 0,
+                "usage": {
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "total_tokens": 0
+                }
             }
-        },
-        "data": data
-    }
+        
+        usage = plan[sample["type"]]["usage"]
+        plan[sample["type"]]["num_requests"] += 1
+        usage["prompt_tokens"] += num_prompt_tokens
+        usage["completion_tokens"] += completion_tokens
+        usage["total_tokens"] += num_prompt_tokens + completion_tokens
 
-    pathlib.Path(args.output_dir).mkdir(parents=True, exist_ok=True)
-    datapath = pathlib.Path(args.datapath)
+    for template_plan in plan.values():
+        usage = template_plan["usage"]
+        input_cost = usage["prompt_tokens"] * MODEL_COSTS[model]["input"]
+        output_cost = usage["completion_tokens"] * MODEL_COSTS[model]["output"]
+        template_plan["cost"] = {
+            "input": input_cost,
+            "output": output_cost,
+            "total": input_cost + output_cost
+        }
+
+    return list(plan.values())
+
+async def evaluate_concurrently(samples, model, model_args, rate_limiter, num_concurrent, on_result, cache=None, budget=None, stopper=None):
+    queue = asyncio.Queue()
+
+    for sample in samples:
+        queue.put_nowait(sample)
+
+    async def worker():
+        while not queue.empty() and (stopper is None or not stopper.stopped):
+            sample = queue.get_nowait()
+            cached = get_cached_response(cache, sample, model, model_args)
+
+            if cached is not None:
+                on_result(sample, *cached)
+                continue
+
+            prompt_tokens, completion_tokens = estimate_request_tokens(sample, model, model_args)
+            reserved_cost = 0
+
+            if budget is not None:
+                reserved_cost = budget.estimate(model, prompt_tokens, completion_tokens)
+
+                if not budget.reserve(reserved_cost):
+                    return
+
+            await rate_limiter.acquire(prompt_tokens + completion_tokens)
+            response, usage = await async_complete(sample, model, model_args)
+            rate_limiter.reconcile(prompt_tokens + completion_tokens, usage["total_tokens"])
+
+            if budget is not None:
+                budget.settle(model, reserved_cost, usage)
+
+            cache_response(cache, sample, model, model_args, response, usage)
+            on_result(sample, response, usage)
+
+    await asyncio.gather(*[worker() for _ in range(num_concurrent)])
+
+def evaluate_response(sample, response):
+    """Scores a response in place and returns its (reference, prediction) pair for binary templates."""
+    if sample["type"] in ["bcq", "bcq_with_kg"]:
+        ref = 1 if sample["answer"].strip().lower() == "yes" else 0
+        pred = 1 if response.strip().lower() == "yes" else 0
+        sample["correct"] = ref == pred
+        return ref, pred
+    
+    if sample["type"] in ["bcq_cot", "bcq_cot_with_kg"]:
+        ref = 1 if sample["answer"].strip().lower() == "yes" else 0
+        match = re.search("<Answer>(?P<pred>.*)</Answer>", response)
+        pred = 0
+
+        if match:
+            pred = match["pred"].strip().lower()
+            pred = 1 if pred == "yes" else 0
+        
+        sample["correct"] = ref == pred
+        return ref, pred
+    
+    if sample["type"] == "mcq":
+        try:
+            gold_answers = [int(a) for a in sample["answer"].split(",")]
+            gpt_answers = [int(a) for a in response.split(",")]
+            refs = [1 if i+1 in gold_answers else 0 for i in range(sample["num_options"])]
+            preds = [1 if i+1 in gpt_answers else 0 for i in range(sample["num_options"])] 
+            
+            sample["references"] = refs
+            sample["predictions"] = preds
+            sample["accuracy"] = accuracy_score(refs, preds)
+            sample["precision"] = precision_score(refs, preds, average="macro")
+            sample["recall"] = recall_score(refs, preds, average="macro")
+            sample["f1"] = f1_score(refs, preds, average="macro")
+        except ValueError:
+            pass
+
+        return None
     
-    output_path = os.path.join(args.output_dir, f"{datapath.stem}_{args.model}_{generate_unique_id()}.json")
-    print(f"Writing to {output_path}")
+    raise ValueError(f"Type {sample['type']} not supported for evaluation.")
+
+def get_batch_request_id(sample, model, model_args):
+    # identical prompts share one request, so the id only depends on what is sent to the provider
+    return get_cache_key("openai", model, sample["prompt"].strip(), model_args)
+
+def build_batch_request(sample, model, model_args):
+    custom_id = get_batch_request_id(sample, model, model_args)
+
+    if model in CHAT_COMPLETION_MODELS:
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": model, "messages": [{"role": "user", "content": sample["prompt"].strip()}], **model_args}
+        }
     
-    for sample in tqdm(data, total=len(data)):
-        if sample["instance_id"] in ignore_map:
-            ignore_instance = ignore_map[sample["instance_id"]]
-            if "response" in ignore_instance:
-                sample.update(ignore_instance)
+    if model in TEXT_COMPLETION_MODELS:
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/completions",
+            "body": {"model": model, "prompt": sample["prompt"].strip(), **model_args}
+        }
+    
+    raise ValueError(f"Model {model} not supported for evaluation.")
+
+def export_batch_requests(samples, model, model_args, path):
+    seen_ids = set()
+
+    with open(path, "w") as f:
+        for sample in samples:
+            request = build_batch_request(sample, model, model_args)
+
+            if request["custom_id"] in seen_ids:
                 continue
+
+            seen_ids.add(request["custom_id"])
+            f.write(json.dumps(request) + "\n")
     
-        if "response" in sample:
+    return len(seen_ids)
+
+def read_batch_results(path):
+    results = {}
+
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            result = json.loads(line)
+            response = result.get("response")
+
+            if result.get("error") or response is None or response.get("status_code") != 200:
+                continue
+
+            body = response["body"]
+            choice = body["choices"][0]
+            text = choice["message"]["content"] if "message" in choice else choice["text"]
+            results[result["custom_id"]] = (text.strip(), body["usage"])
+    
+    return results
+
+def ingest_batch_results(run, batch_path, model_args, cache=None):
+    batch_results = read_batch_results(batch_path)
+    num_missing = 0
+
+    for sample in run.pending_samples:
+        custom_id = get_batch_request_id(sample, run.model, model_args)
+
+        if custom_id not in batch_results:
+            num_missing += 1
             continue
 
-        if args.model in CHAT_COMPLETION_MODELS:
-            response, usage = chat_completion([{"role": "user", "content": sample["prompt"].strip()}], model=args.model, return_text=True, return_usage=True, model_args={
-                "temperature": args.temperature,
-                "max_tokens": args.max_tokens,
-                "top_p": args.top_p,
-                "frequency_penalty": args.frequency_penalty,
-                "presence_penalty": args.presence_penalty
-            })
-        elif args.model in TEXT_COMPLETION_MODELS:
-            response, usage = text_completion(sample["prompt"].strip(), model=args.model, return_text=True, return_usage=True, model_args={
+        response, usage = batch_results[custom_id]
+        cache_response(cache, sample, run.model, model_args, response, usage)
+        run.on_result(sample, response, usage)
+    
+    if num_missing > 0:
+        print(f"{num_missing} instances have no successful result in {batch_path}, resume this run to evaluate them")
+
+def evaluate_sequentially(run, model_args, cache=None, budget=None):
+    for sample in run.pending_samples:
+        if run.stopper is not None and run.stopper.stopped:
+            break
+
+        cached = get_cached_response(cache, sample, run.model, model_args)
+
+        if cached is not None:
+            run.on_result(sample, *cached)
+            continue
+
+        reserved_cost = 0
+
+        if budget is not None:
+            reserved_cost = budget.estimate(run.model, *estimate_request_tokens(sample, run.model, model_args))
+
+            if not budget.reserve(reserved_cost):
+                break
+
+        response, usage = complete(sample, run.model, model_args)
+
+        if budget is not None:
+            budget.settle(run.model, reserved_cost, usage)
+
+        cache_response(cache, sample, run.model, model_args, response, usage)
+        run.on_result(sample, response, usage)
+
+async def evaluate_runs_concurrently(runs, model_args, args, cache=None, budget=None):
+    evaluations = []
+
+    # every model gets its own workers and rate limiter, all driven by the same event loop
+    for run in runs:
+        rate_limits = MODEL_RATE_LIMITS.get(run.model, {})
+        rpm = args.rpm if args.rpm is not None else rate_limits["rpm"]
+        tpm = args.tpm if args.tpm is not None else rate_limits["tpm"]
+        run.outputs["metadata"]["num_concurrent"] = args.num_concurrent
+        run.outputs["metadata"]["rate_limits"] = {"rpm": rpm, "tpm": tpm}
+        evaluations.append(evaluate_concurrently(run.pending_samples, run.model, model_args, RateLimiter(rpm, tpm), args.num_concurrent, run.on_result, cache=cache, budget=budget, stopper=run.stopper))
+    
+    await asyncio.gather(*evaluations)
+
+def find_resume_paths(resume_paths, models):
+    """Journal of every model to resume, matched by the _{model}_ in its file name unless a single model resumes a single journal."""
+    if len(models) == 1 and len(resume_paths) == 1:
+        return {models[0]: resume_paths[0]}
+
+    matched = {}
+
+    for resume_path in resume_paths:
+        path_models = [model for model in models if f"_{model}_" in pathlib.Path(resume_path).name]
+
+        # an unmatched journal would silently start its model again and pay for every request twice
+        if not path_models:
+            raise ValueError(f"Journal {resume_path} matches none of the models {models}, its file name must contain _<model>_.")
+
+        for model in path_models:
+            if model in matched:
+                raise ValueError(f"Journals {matched[model]} and {resume_path} both match model {model}.")
+
+            matched[model] = resume_path
+
+    missing = [model for model in models if model not in matched]
+
+    if missing:
+        raise ValueError(f"No journal to resume for models {missing} among {resume_paths}.")
+
+    return matched
+
+class ModelRun():
+    """Outputs, journal and running metrics of one model evaluated on a prepared data file."""
+
+    def __init__(self, model, data, args, resume_path=None):
+        self.model = model
+        self.data = copy.deepcopy(data)
+        self.predictions = []
+        self.references = []
+        self.stopper = None
+        self.progress_bar = None
+
+        if args.ci_half_width is not None:
+            self.stopper = SequentialStopper(Counter(sample["data_id"] for sample in self.data), args.ci_half_width, confidence=args.ci_confidence, min_groups=args.ci_min_groups, check_every=args.ci_check_every, seed=args.seed)
+
+        self.outputs = {
+            "metadata": {
+                "datapath": args.datapath,
+                "model": model,
                 "temperature": args.temperature,
                 "max_tokens": args.max_tokens,
                 "top_p": args.top_p,
                 "frequency_penalty": args.frequency_penalty,
                 "presence_penalty": args.presence_penalty
-            })
+            },
+            "metrics": {
+                "accuracy": 0,
+                "precision": 0,
+                "recall": 0,
+                "f1": 0,
+                "usage": {
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "total_tokens": 0
+                },
+                "cost": {
+                    "input": 0,
+                    "output": 0,
+                    "total": 0
+                }
+            },
+            "data": self.data
+        }
+
+        if resume_path is not None:
+            self.journal_path = resume_path
+            self.output_path = get_output_path(resume_path)
         else:
-            raise ValueError(f"Model {args.model} not supported for evaluation.")
+            output_dir = args.output_dir.format(model=model)
+            pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+            datapath = pathlib.Path(args.datapath)
+            self.output_path = os.path.join(output_dir, f"{datapath.stem}_{model}_{generate_unique_id()}.json")
+            self.journal_path = get_journal_path(self.output_path)
+
+        print(f"Writing to {self.output_path}")
+        self.journal = RunJournal(self.journal_path, sync_every=args.sync_every)
+        journal_records = self.journal.load() if resume_path is not None else {}
+        self.pending_samples = []
+
+        for sample in self.data:
+            if sample["instance_id"] in journal_records:
+                sample.update(journal_records[sample["instance_id"]])
+                self.accumulate(sample)
+                continue
+        
+            if "response" in sample:
+                continue
+
+            self.pending_samples.append(sample)
+
+        if journal_records:
+            print(f"Resuming from {self.journal_path} with {len(journal_records)} instances already evaluated")
+
+    def accumulate(self, sample):
+        usage = sample["usage"]
+        self.outputs["metrics"]["usage"]["prompt_tokens"] += usage["prompt_tokens"]
+        self.outputs["metrics"]["usage"]["completion_tokens"] += usage["completion_tokens"]
+        self.outputs["metrics"]["usage"]["total_tokens"] += usage["total_tokens"]
 
+        pred_ref = evaluate_response(sample, sample["response"])
+
+        if pred_ref is not None:
+            ref, pred = pred_ref
+            self.references.append(ref)
+            self.predictions.append(pred)
+
+            if self.stopper is not None:
+                self.stopper.add(sample["data_id"], ref, pred)
+
+    def open(self):
+        self.journal.open()
+        self.progress_bar = tqdm(total=len(self.pending_samples), desc=self.model)
+
+    def on_result(self, sample, response, usage):
         sample["response"] = response
         sample["usage"] = usage
-        outputs["metrics"]["usage"]["prompt_tokens"] += usage["prompt_tokens"]
-        outputs["metrics"]["usage"]["completion_tokens"] += usage["completion_tokens"]
-        outputs["metrics"]["usage"]["total_tokens"] += usage["total_tokens"]
-
-        if sample["type"] in ["bcq", "bcq_with_kg"]:
-            ref = 1 if sample["answer"].strip().lower() == "yes" else 0
-            pred = 1 if response.strip().lower() == "yes" else 0
-            references.append(ref)
-            predictions.append(pred)
-            sample["correct"] = ref == pred
-        elif sample["type"] in ["bcq_cot", "bcq_cot_with_kg"]:
-            ref = 1 if sample["answer"].strip().lower() == "yes" else 0
-            match = re.search("<Answer>(?P<pred>.*)</Answer>", response)
-            pred = 0
-
-            if match:
-                pred = match["pred"].strip().lower()
-                pred = 1 if pred == "yes" else 0
-            
-            references.append(ref)
-            predictions.append(pred)
-            sample["correct"] = ref == pred
-        elif sample["type"] == "mcq":
-            try:
-                gold_answers = [int(a) for a in sample["answer"].split(",")]
-                gpt_answers = [int(a) for a in response.split(",")]
-                refs = [1 if i+1 in gold_answers else 0 for i in range(sample["num_options"])]
-                preds = [1 if i+1 in gpt_answers else 0 for i in range(sample["num_options"])] 
-                
-                sample["references"] = refs
-                sample["predictions"] = preds
-                sample["accuracy"] = accuracy_score(refs, preds)
-                sample["precision"] = precision_score(refs, preds, average="macro")
-                sample["recall"] = recall_score(refs, preds, average="macro")
-                sample["f1"] = f1_score(refs, preds, average="macro")
-            except ValueError:
-                continue 
+        self.accumulate(sample)
+        self.journal.record(sample)
+        self.progress_bar.update(1)
+
+    def close(self):
+        self.journal.close()
+
+        if self.progress_bar is not None:
+            self.progress_bar.close()
+
+    def finalize(self):
+        outputs = self.outputs
+
+        if self.stopper is not None:
+            outputs["metadata"]["sequential"] = self.stopper.stats()
+
+        if self.predictions:
+            outputs["metrics"]["accuracy"] = accuracy_score(self.references, self.predictions)
+            outputs["metrics"]["precision"] = precision_score(self.references, self.predictions, average="macro")
+            outputs["metrics"]["recall"] = recall_score(self.references, self.predictions, average="macro")
+            outputs["metrics"]["f1"] = f1_score(self.references, self.predictions, average="macro")
         else:
-            raise ValueError(f"Type {sample['type']} not supported for evaluation.")
+            outputs["metrics"]["accuracy"] = np.mean([sample["accuracy"] for sample in self.data if "accuracy" in sample])
+            outputs["metrics"]["precision"] = np.mean([sample["precision"] for sample in self.data if "precision" in sample])
+            outputs["metrics"]["recall"] = np.mean([sample["recall"] for sample in self.data if "recall" in sample])
+            outputs["metrics"]["f1"] = np.mean([sample["f1"] for sample in self.data if "f1" in sample])
+
+        outputs["metrics"]["cost"]["input"] = outputs["metrics"]["usage"]["prompt_tokens"] * MODEL_COSTS[self.model]["input"]
+        outputs["metrics"]["cost"]["output"] = outputs["metrics"]["usage"]["completion_tokens"] * MODEL_COSTS[self.model]["output"]
+        outputs["metrics"]["cost"]["total"] = outputs["metrics"]["cost"]["input"] + outputs["metrics"]["cost"]["output"]
+
+        write_json(outputs, self.output_path)
+
+def format_model_path(path, model, models):
+    if "{model}" in path:
+        return path.format(model=model)
+
+    if len(models) > 1:
+        raise ValueError(f"Path {path} must contain a {{model}} placeholder when evaluating several models.")
+
+    return path
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datapath", type=str, help="Path to evaluation data in json", required=True)
+    parser.add_argument("--openai-key", type=str, help="OpenAI API Key", required=True)
+    parser.add_argument("--model", type=str, help="Model to use for evaluation", default="gpt-3.5-turbo")
+    parser.add_argument("--models", type=str, nargs="+", help="Models to evaluate on the same data in one run (overrides --model)", default=None)
+    parser.add_argument("--temperature", type=float, help="Temperature for generation", default=0.3)
+    parser.add_argument("--max-tokens", type=int, help="Max tokens for generation", default=40)
+    parser.add_argument("--top-p", type=float, help="Top p for generation", default=1)
+    parser.add_argument("--frequency-penalty", type=float, help="Frequency penalty for generation", default=0)
+    parser.add_argument("--presence-penalty", type=float, help="Presence penalty for generation", default=0)
+    parser.add_argument("--output-dir", type=str, help="Output directory for evaluation results, may contain a {model} placeholder", default="outputs")
+    parser.add_argument("--num-samples", type=int, help="Number of samples to evaluate", default=0)
+    parser.add_argument("--resume", type=str, nargs="+", help="Paths to the run journals (.jsonl) of an interrupted run to resume, matched to models by the _<model>_ in their file name", default=None)
+    parser.add_argument("--sync-every", type=int, help="Number of finished instances between journal fsyncs", default=50)
+    parser.add_argument("--batch-export", type=str, help="Write one batch request per unique prompt to this JSONL file instead of calling the API (needs a {model} placeholder for several models)", default=None)
+    parser.add_argument("--batch-ingest", type=str, help="Build the outputs from this batch results JSONL file instead of calling the API (needs a {model} placeholder for several models)", default=None)
+    parser.add_argument("--plan", action="store_true", default=False, help="Project token usage and cost of the pending requests and exit without calling the API")
+    parser.add_argument("--plan-output", type=str, help="Path to write the projected usage and cost to in json", default=None)
+    parser.add_argument("--plan-completion-tokens", type=int, help="Projected completion tokens per request (defaults to --max-tokens)", default=None)
+    parser.add_argument("--num-threads", type=int, help="Number of threads to tokenize prompts with when planning", default=8)
+    parser.add_argument("--max-cost", type=float, help="Stop dispatching requests once the projected spend of this invocation would exceed this many dollars", default=None)
+    parser.add_argument("--ci-half-width", type=float, help="Stop once the bootstrap confidence interval of macro-F1 is at most this half-width (evaluates everything if not given)", default=None)
+    parser.add_argument("--ci-confidence", type=float, help="Confidence level of the stopping interval", default=0.95)
+    parser.add_argument("--ci-min-groups", type=int, help="Minimum number of finished data_id groups before the stopping rule is checked", default=30)
+    parser.add_argument("--ci-check-every", type=int, help="Number of finished data_id groups between checks of the stopping rule", default=25)
+    parser.add_argument("--seed", type=int, help="Seed for the stratified evaluation order of --ci-half-width", default=None)
+    parser.add_argument("--cache-path", type=str, help="Path to the SQLite response cache shared across runs (disabled if not given)", default=None)
+    parser.add_argument("--cache-max-size", type=int, help="Maximum size of the response cache in bytes", default=2 * 1024 ** 3)
+    parser.add_argument("--num-concurrent", type=int, help="Number of requests in flight at once per model (1 evaluates a single model sequentially)", default=1)
+    parser.add_argument("--rpm", type=int, help="Requests per minute budget of each model for concurrent evaluation (defaults to the model rate limit)", default=None)
+    parser.add_argument("--tpm", type=int, help="Tokens per minute budget of each model for concurrent evaluation (defaults to the model rate limit)", default=None)
+    
+    args = parser.parse_args()
+    openai.api_key = args.openai_key 
+    models = args.models if args.models is not None else [args.model]
+    data = read_json(args.datapath)
+
+    if args.num_samples > 0:
+        data = data[:int(args.num_samples)]
+
+    if args.ci_half_width is not None:
+        if args.seed is None:
+            args.seed = random.randint(0, 2 ** 32)
+
+        data = stratified_group_order(data, seed=args.seed)
+
+    if args.num_concurrent > 1 or len(models) > 1:
+        for model in models:
+            if model not in MODEL_RATE_LIMITS and (args.rpm is None or args.tpm is None):
+                parser.error(f"No known rate limits for {model}, give its budget with --rpm and --tpm.")
+
+    resume_paths = find_resume_paths(args.resume, models) if args.resume is not None else {}
+    runs = [ModelRun(model, data, args, resume_path=resume_paths.get(model)) for model in models]
+
+    model_args = {
+        "temperature": args.temperature,
+        "max_tokens": args.max_tokens,
+        "top_p": args.top_p,
+        "frequency_penalty": args.frequency_penalty,
+        "presence_penalty": args.presence_penalty
+    }
+
+    if args.batch_export is not None:
+        for run in runs:
+            batch_path = format_model_path(args.batch_export, run.model, models)
+            num_requests = export_batch_requests(run.pending_samples, run.model, model_args, batch_path)
+            print(f"Wrote {num_requests} batch requests for {len(run.pending_samples)} instances to {batch_path}")
+        return
+
+    cache = ResponseCache(args.cache_path, max_size=args.cache_max_size) if args.cache_path is not None else None
+
+    if args.plan:
+        task = next((task for task in TASKS if task in args.datapath), None)
+        plans = {}
+
+        for run in runs:
+            # cached responses are free, so only the requests that would actually be sent are projected
+            uncached_samples = [sample for sample in run.pending_samples if get_cached_response(cache, sample, run.model, model_args) is None]
+            plans[run.model] = plan_usage(uncached_samples, run.model, model_args, task, completion_tokens=args.plan_completion_tokens, num_threads=args.num_threads)
         
-        write_json(outputs, output_path)
-
-    if predictions:
-        outputs["metrics"]["accuracy"] = accuracy_score(references, predictions)
-        outputs["metrics"]["precision"] = precision_score(references, predictions, average="macro")
-        outputs["metrics"]["recall"] = recall_score(references, predictions, average="macro")
-        outputs["metrics"]["f1"] = f1_score(references, predictions, average="macro")
-    else:
-        outputs["metrics"]["accuracy"] = np.mean([sample["accuracy"] for sample in data if "accuracy" in sample])
-        outputs["metrics"]["precision"] = np.mean([sample["precision"] for sample in data if "precision" in sample])
-        outputs["metrics"]["recall"] = np.mean([sample["recall"] for sample in data if "recall" in sample])
-        outputs["metrics"]["f1"] = np.mean([sample["f1"] for sample in data if "f1" in sample])
-
-    outputs["metrics"]["cost"]["input"] = outputs["metrics"]["usage"]["prompt_tokens"] * MODEL_COSTS[args.model]["input"]
-    outputs["metrics"]["cost"]["output"] = outputs["metrics"]["usage"]["completion_tokens"] * MODEL_COSTS[args.model]["output"]
-    outputs["metrics"]["cost"]["total"] = outputs["metrics"]["cost"]["input"] + outputs["metrics"]["cost"]["output"]
-
-    write_json(outputs, output_path)
+        pprint.pprint(plans)
+
+        if args.plan_output is not None:
+            write_json({"datapath": args.datapath, "plan": plans}, args.plan_output)
+
+        if cache is not None:
+            cache.close()
+
+        return
+
+    budget = CostBudget(args.max_cost, MODEL_COSTS) if args.max_cost is not None else None
+
+    for run in runs:
+        run.open()
+
+    try:
+        if args.batch_ingest is not None:
+            for run in runs:
+                batch_path = format_model_path(args.batch_ingest, run.model, models)
+                run.outputs["metadata"]["batch_results"] = batch_path
+                ingest_batch_results(run, batch_path, model_args, cache=cache)
+        elif args.num_concurrent > 1 or len(runs) > 1:
+            asyncio.run(evaluate_runs_concurrently(runs, model_args, args, cache=cache, budget=budget))
+        else:
+            evaluate_sequentially(runs[0], model_args, cache=cache, budget=budget)
+    finally:
+        for run in runs:
+            run.close()
+
+        if cache is not None:
+            cache.close()
+
+    for run in runs:
+        if args.ci_half_width is not None:
+            run.outputs["metadata"]["seed"] = args.seed
+
+        if cache is not None:
+            run.outputs["metadata"]["cache"] = cache.stats()
+
+        if budget is not None:
+            run.outputs["metadata"]["budget"] = budget.stats()
+
+        run.finalize()
+
+    if budget is not None and budget.exhausted:
+        print(f"Budget of ${args.max_cost} reached after spending ${budget.spent:.4f}, resume with --resume {' '.join(run.journal_path for run in runs)}")
 
 if __name__ == "__main__":
     main()
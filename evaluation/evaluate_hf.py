@@ -4,15 +4,36 @@ from tqdm import tqdm
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
 import pathlib
 import sys
-from collections import defaultdict
+from collections import defaultdict, Counter
 import os
-from transformers import AutoModelForCausalLM, AutoTokenizer, AutoModelForSeq2SeqLM, set_seed
+from transformers import AutoModelForCausalLM, AutoTokenizer, AutoModelForSeq2SeqLM, set_seed, StoppingCriteria, StoppingCriteriaList, LogitsProcessorList, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+from transformers.modeling_outputs import BaseModelOutput
 import torch
+import numpy as np
 import random
+import inspect
+import copy
+import multiprocessing
+import time
+import contextlib
+import re
+import itertools
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
 
 sys.path.append("..")
 
-from utils import read_json, write_json, generate_unique_id
+from utils import read_json, write_json, generate_unique_id, predict_with_strategy
+from journal import RunJournal, get_journal_path, get_output_path, get_shard_journal_path, load_shard_journals
+from response_cache import ResponseCache
+from sequential import SequentialStopper, stratified_group_order
+from model_client import ModelClient
+from weights_cache import resolve_checkpoint, WEIGHTS_CACHE_DIR
+from calibration import get_content_free_prompts, get_calibration_path, load_biases, save_biases
+from token_cache import get_token_cache, TokenCache, TOKEN_CACHE_DIR
 
 MODELS_MAP = {
     "gpt2": "gpt2",
@@ -30,36 +51,72 @@ MODELS_MAP = {
     "bloomz7": "bigscience/bloomz-7b1"
 }
 
+# number of batches whose prompts are sorted by length together, larger windows pad less but journal less often
+SORT_WINDOW_BATCHES = 16
+
+PRECISIONS = ["fp32", "bf16", "int8-dynamic"]
+
+# chain-of-thought templates reason before giving their answer within these tags
+COT_TEMPLATES = ["bcq_cot", "bcq_cot_with_kg"]
+ANSWER_END_TAG = "</Answer>"
+
+class StopOnString(StoppingCriteria):
+    """Stops every sequence whose generated tokens end with the given string, ignoring the prompt."""
+
+    def __init__(self, tokenizer, stop_string, start):
+        self.tokenizer = tokenizer
+        self.stop_string = stop_string
+        self.start = start
+        # enough trailing tokens to hold the string, decoded instead of the whole generation at every step
+        self.num_tokens = len(tokenizer.encode(stop_string, add_special_tokens=False)) + 2
+
+    def __call__(self, input_ids, scores, **kwargs):
+        tails = self.tokenizer.batch_decode(input_ids[:, max(self.start, input_ids.shape[1] - self.num_tokens):], skip_special_tokens=True)
+        return torch.tensor([self.stop_string in tail for tail in tails], dtype=torch.bool, device=input_ids.device)
+
 
 class ModelWrapper():
-    def __init__(self, model_name, logger = None):
+    def __init__(self, model_name, logger = None, precision = "fp32", weights_cache_dir = WEIGHTS_CACHE_DIR, draft_model_name = None):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Precision {precision} not supported, choose one of {PRECISIONS}.")
+
         self.letters_biases = defaultdict(lambda: 0)
         self.model_name = model_name
         self.logger = logger
+        self.precision = precision
+        self.weights_cache_dir = weights_cache_dir
+        torch_dtype = torch.bfloat16 if precision == "bf16" else torch.float32
+        self.prefix_ids = []
+        self.prefix_cache = None
+        self.draft_model = None
+        self.draft_model_name = draft_model_name
+        self.generation_stats = Counter()
         if model_name.startswith("llama") or model_name == "alpaca" or model_name == "bloomz7" or "vicuna" in model_name:
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
             self.engine = MODELS_MAP[model_name]
-            self.model = AutoModelForCausalLM.from_pretrained(self.engine, device_map="auto")
+            self.model = self.load_pretrained(AutoModelForCausalLM, device_map="auto", torch_dtype=torch_dtype)
             print("Model loaded: ", self.model.hf_device_map)
             self.tokenizer = AutoTokenizer.from_pretrained(self.engine)
             print("Tokenizer loaded")
             self.model.eval()
+            self.set_left_padding()
             self.yes_token_id = self.tokenizer.convert_tokens_to_ids("yes")
             self.no_token_id = self.tokenizer.convert_tokens_to_ids("no")
         elif model_name == "gpt2":
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
             self.engine = MODELS_MAP[model_name]
-            self.model = AutoModelForCausalLM.from_pretrained(self.engine).to(self.device)
+            self.model = self.load_pretrained(AutoModelForCausalLM, torch_dtype=torch_dtype).to(self.device)
             print("Model loaded: ", self.model.device)
             self.tokenizer = AutoTokenizer.from_pretrained(self.engine)
             print("Tokenizer loaded")
             self.model.eval()
+            self.set_left_padding()
             self.yes_token_id = self.tokenizer.get_vocab()["yes"]
             self.no_token_id = self.tokenizer.get_vocab()["no"]
         elif model_name in ["t5","flan-t5", "flan-alpaca", "mt0", "mt5"]:
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
             self.engine = MODELS_MAP[model_name]
-            self.model = AutoModelForSeq2SeqLM.from_pretrained(self.engine, device_map="auto")
+            self.model = self.load_pretrained(AutoModelForSeq2SeqLM, device_map="auto", torch_dtype=torch_dtype)
             print("Model loaded: ", self.model.hf_device_map)            
             self.tokenizer = AutoTokenizer.from_pretrained(self.engine)
             self.tokenizer.pad_token = self.tokenizer.eos_token
@@ -68,27 +125,927 @@ class ModelWrapper():
             self.yes_token_id = self.tokenizer.encode("yes", add_special_tokens=False)[0]
             self.no_token_id = self.tokenizer.encode("no", add_special_tokens=False)[0]
 
+        if draft_model_name is not None:
+            self.load_draft_model(draft_model_name, torch_dtype)
+
+        if precision == "int8-dynamic":
+            self.quantize_dynamic()
+
+    def load_pretrained(self, model_class, engine=None, **kwargs):
+        # safetensors checkpoints are memory-mapped, so weights are paged in instead of copied through a state dict
+        start = time.perf_counter()
+        model = model_class.from_pretrained(resolve_checkpoint(engine or self.engine, self.weights_cache_dir), low_cpu_mem_usage=True, **kwargs)
+        self.load_time = time.perf_counter() - start
+        print(f"Model loaded in {self.load_time:.1f}s")
+        return model
+
+    def load_draft_model(self, draft_model_name, torch_dtype):
+        """Loads the small model proposing the tokens that the model verifies in assisted generation."""
+        load_time = self.load_time
+        draft_engine = MODELS_MAP[draft_model_name]
+
+        # candidate tokens are verified by id, so both models must share one vocabulary
+        if AutoTokenizer.from_pretrained(draft_engine).get_vocab() != self.tokenizer.get_vocab():
+            raise ValueError(f"Draft model {draft_model_name} does not share the tokenizer of {self.model_name}.")
+
+        model_class = AutoModelForSeq2SeqLM if self.is_encoder_decoder() else AutoModelForCausalLM
+        self.draft_model = self.load_pretrained(model_class, engine=draft_engine, torch_dtype=torch_dtype).to(self.model.device)
+        self.draft_model.eval()
+        self.load_time += load_time
+        print(f"Draft model {draft_model_name} loaded")
+
+    def quantize_dynamic(self):
+        # dynamic quantization only has CPU kernels, and only nn.Linear layers are converted (not the Conv1D of gpt2)
+        if self.device.type != "cpu":
+            raise ValueError(f"Precision int8-dynamic needs a CPU-only node, found {self.device}.")
+
+        self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        if self.draft_model is not None:
+            self.draft_model = torch.quantization.quantize_dynamic(self.draft_model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        print("Model quantized to int8")
+
     def get_model_name(self):
         return self.model_name
+
+    def set_left_padding(self):
+        # decoder-only models continue from the last position, so batched prompts must end at the same index
+        self.tokenizer.padding_side = "left"
+
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def is_encoder_decoder(self):
+        return self.model_name in ["t5","flan-t5", "flan-alpaca", "mt0", "mt5"]
+
+    def get_prompt_lengths(self, prompts):
+        return [len(input_ids) for input_ids in self.tokenizer(prompts)["input_ids"]]
+
+    def tokenize(self, prompts, input_ids=None):
+        # prompts pre-tokenized by the token cache are used as they are
+        return self.tokenizer(prompts)["input_ids"] if input_ids is None else input_ids
+
+    def pad_input_ids(self, input_ids):
+        inputs = self.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+        return inputs["input_ids"].to(self.device), inputs["attention_mask"].to(self.device)
                     
     def generate_answer(self, prompt, max_tokens=1, temperature=0.5, top_k=20, top_p=0.95, do_sample=True):
-        inputs = self.tokenizer(prompt, return_tensors="pt")
-        input_ids = inputs["input_ids"].to(self.device)
-        outputs = self.model.generate(input_ids, max_new_tokens=max_tokens, temperature=temperature, top_p=top_p, do_sample=do_sample, num_return_sequences=1, min_new_tokens=1, early_stopping=True, return_dict_in_generate=True, output_scores=True)
-        yes_logit_scores = outputs.scores[0][:,self.yes_token_id]
-        no_logit_scores = outputs.scores[0][:,self.no_token_id]
-        #output = "yes" if torch.softmax(no_logit_scores, dim=0) <  torch.softmax(yes_logit_scores, dim=0) else "no"
-        proba_output = "yes" if no_logit_scores <  yes_logit_scores else "no"
+        answer = self.generate_answers([prompt], max_tokens=max_tokens, temperature=temperature, top_k=top_k, top_p=top_p, do_sample=do_sample)[0]
+        return answer["highest_proba"], answer["generated_output"]
+
+    def get_position_ids(self, attention_mask, offset=0):
+        # padded prompts are shifted, so positions are counted from the first real token as in generate
+        position_ids = attention_mask.long().cumsum(-1) - 1 + offset
+        return position_ids.masked_fill(attention_mask == 0, 1)
+
+    def accepts_position_ids(self):
+        return "position_ids" in inspect.signature(self.model.forward).parameters
+
+    @torch.no_grad()
+    def set_shared_prefix(self, prompts, input_ids=None):
+        """Encodes the longest token prefix shared by all prompts once, so that scoring only runs the suffixes."""
+        self.prefix_ids = []
+        self.prefix_cache = None
+
+        if self.is_encoder_decoder() or not prompts:
+            return 0
+
+        all_input_ids = self.tokenize(prompts, input_ids)
+        prefix_ids = all_input_ids[0]
+
+        for input_ids in all_input_ids[1:]:
+            length = 0
+
+            while length < min(len(prefix_ids), len(input_ids)) and prefix_ids[length] == input_ids[length]:
+                length += 1
+
+            prefix_ids = prefix_ids[:length]
+
+        # every prompt keeps at least one token, whose logits give the answer
+        prefix_ids = prefix_ids[:min(len(input_ids) for input_ids in all_input_ids) - 1]
+
+        if not prefix_ids:
+            return 0
+
+        self.prefix_ids = prefix_ids
+        self.prefix_cache = self.model(input_ids=torch.tensor([prefix_ids], device=self.device), use_cache=True).past_key_values
+
+        return len(prefix_ids)
+
+    def get_prefix_cache(self, batch_size):
+        return self.repeat_cache(self.prefix_cache, batch_size)
+
+    def repeat_cache(self, cache, batch_size):
+        # cache objects are extended in place by the forward pass, so every batch works on its own copy
+        if hasattr(cache, "batch_repeat_interleave"):
+            past_key_values = copy.deepcopy(cache)
+            past_key_values.batch_repeat_interleave(batch_size)
+            return past_key_values
+
+        # the first dimension is the batch, or batch times heads for bloom, so repeating it works for both layouts
+        past_key_values = tuple(tuple(tensor.repeat(batch_size, *[1] * (tensor.dim() - 1)) for tensor in layer) for layer in cache)
+
+        if DynamicCache is not None and hasattr(DynamicCache, "from_legacy_cache"):
+            return DynamicCache.from_legacy_cache(past_key_values)
+
+        return past_key_values
+
+    def get_scored_answers(self, logits):
+        # contextual calibration divides the answer probabilities by those of content-free prompts, a shift of the logits
+        answer_logits = logits[:, [self.yes_token_id, self.no_token_id]].float() - torch.tensor([self.letters_biases["yes"], self.letters_biases["no"]], device=logits.device)
+        proba_outputs = ["yes" if no_logit_score < yes_logit_score else "no" for yes_logit_score, no_logit_score in answer_logits.tolist()]
+        return [{"highest_proba": proba_output, "probabilities": probabilities} for proba_output, probabilities in zip(proba_outputs, self.get_answer_probabilities(answer_logits))]
+
+    def set_letters_biases(self, biases):
+        self.letters_biases.clear()
+        self.letters_biases.update(biases)
+
+    def calibrate(self, content_free_prompts):
+        """Sets the yes/no log-biases to the mean answer probabilities of content-free prompts and returns them."""
+        self.letters_biases.clear()
+        prefix_ids, prefix_cache = self.prefix_ids, self.prefix_cache
+        # content-free prompts may diverge from the real ones inside their shared prefix
+        self.prefix_ids, self.prefix_cache = [], None
+        answers = self.score_answers(content_free_prompts)
+        self.prefix_ids, self.prefix_cache = prefix_ids, prefix_cache
+
+        for label in ["yes", "no"]:
+            self.letters_biases[label] = float(np.log(np.mean([answer["probabilities"][label] for answer in answers])))
+
+        return dict(self.letters_biases)
+
+    def continues_prefix(self, prompt_ids):
+        # every prompt keeps at least one token after the prefix, whose logits give the answer
+        return self.prefix_cache is not None and len(prompt_ids) > len(self.prefix_ids) and list(prompt_ids[:len(self.prefix_ids)]) == self.prefix_ids
+
+    @torch.no_grad()
+    def score_answers_with_prefix(self, all_input_ids):
+        prefix_length = len(self.prefix_ids)
+        suffixes = [prompt_ids[prefix_length:] for prompt_ids in all_input_ids]
+        suffix_length = max(len(suffix) for suffix in suffixes)
+
+        # suffixes are right-padded so that they all continue the cached prefix directly
+        input_ids = torch.full((len(suffixes), suffix_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        suffix_mask = torch.zeros((len(suffixes), suffix_length), dtype=torch.long)
+
+        for index, suffix in enumerate(suffixes):
+            input_ids[index, :len(suffix)] = torch.tensor(suffix, dtype=torch.long)
+            suffix_mask[index, :len(suffix)] = 1
+
+        input_ids = input_ids.to(self.device)
+        suffix_mask = suffix_mask.to(self.device)
+        attention_mask = torch.cat([torch.ones((len(suffixes), prefix_length), dtype=torch.long, device=self.device), suffix_mask], dim=1)
+        model_inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "past_key_values": self.get_prefix_cache(len(suffixes)), "use_cache": True}
+
+        if self.accepts_position_ids():
+            model_inputs["position_ids"] = self.get_position_ids(suffix_mask, offset=prefix_length)
+
+        logits = self.model(**model_inputs).logits
+        last_positions = suffix_mask.sum(dim=1) - 1
+        return self.get_scored_answers(logits[torch.arange(len(suffixes), device=logits.device), last_positions])
+
+    def pad_options(self, options, start_token_id=None):
+        option_ids = [self.tokenizer.encode(option, add_special_tokens=False) for option in options]
+        max_length = max(len(ids) for ids in option_ids)
+        input_ids = torch.full((len(options), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        target_ids = torch.full((len(options), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        target_mask = torch.zeros((len(options), max_length), dtype=torch.long)
+
+        for index, ids in enumerate(option_ids):
+            # encoder-decoder models read the options shifted right behind the decoder start token
+            input_ids[index, :len(ids)] = torch.tensor([start_token_id] + ids[:-1] if start_token_id is not None else ids, dtype=torch.long)
+            target_ids[index, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            target_mask[index, :len(ids)] = 1
+
+        return input_ids.to(self.device), target_ids.to(self.device), target_mask.to(self.device)
+
+    def get_option_scores(self, logits, target_ids, target_mask):
+        logits = logits.float()
+        target_logprobs = logits.gather(-1, target_ids.unsqueeze(-1)).squeeze(-1) - torch.logsumexp(logits, dim=-1)
+        return target_logprobs.masked_fill(target_mask == 0, 0).sum(dim=-1).tolist()
+
+    @torch.no_grad()
+    def score_options(self, prompt, options, context_ids=None):
+        """Log-likelihood of every option continuing the prompt, with the prompt encoded once for all options."""
+        context_ids = self.tokenize([prompt], [context_ids] if context_ids is not None else None)[0]
+
+        if self.is_encoder_decoder():
+            encoder_outputs = self.model.get_encoder()(input_ids=torch.tensor([context_ids], device=self.device))
+            decoder_input_ids, target_ids, target_mask = self.pad_options(options, start_token_id=self.model.config.decoder_start_token_id)
+            hidden_states = encoder_outputs.last_hidden_state.expand(len(options), -1, -1)
+            logits = self.model(encoder_outputs=BaseModelOutput(last_hidden_state=hidden_states), decoder_input_ids=decoder_input_ids).logits
+            return self.get_option_scores(logits, target_ids, target_mask)
+
+        past_key_values = None
+        start = 0
+
+        if self.continues_prefix(context_ids):
+            past_key_values = self.get_prefix_cache(1)
+            start = len(self.prefix_ids)
+
+        outputs = self.model(input_ids=torch.tensor([context_ids[start:]], device=self.device), past_key_values=past_key_values, use_cache=True)
+        input_ids, target_ids, target_mask = self.pad_options(options)
+
+        # the first option token is predicted by the last context position, the following ones by the option tokens before them
+        logits = outputs.logits[:, -1:, :].expand(len(options), -1, -1)
+
+        if input_ids.shape[1] > 1:
+            option_inputs = input_ids[:, :-1]
+            option_mask = target_mask[:, :-1]
+            attention_mask = torch.cat([torch.ones((len(options), len(context_ids)), dtype=torch.long, device=self.device), option_mask], dim=1)
+            model_inputs = {"input_ids": option_inputs, "attention_mask": attention_mask, "past_key_values": self.repeat_cache(outputs.past_key_values, len(options)), "use_cache": True}
+
+            if self.accepts_position_ids():
+                model_inputs["position_ids"] = self.get_position_ids(torch.ones_like(option_mask), offset=len(context_ids))
+
+            logits = torch.cat([logits, self.model(**model_inputs).logits], dim=1)
+
+        return self.get_option_scores(logits, target_ids, target_mask)
+
+    def get_answer_probabilities(self, answer_logits):
+        # softmax restricted to the two answer tokens, so the probabilities of yes and no sum to one
+        probabilities = torch.softmax(answer_logits, dim=-1).tolist()
+        return [{"yes": proba_yes, "no": proba_no} for proba_yes, proba_no in probabilities]
+
+    @torch.no_grad()
+    def score_answers(self, prompts, input_ids=None):
+        all_input_ids = self.tokenize(prompts, input_ids)
+
+        if self.prefix_cache is None:
+            return self.score_answers_without_prefix(all_input_ids)
+
+        # the prefix can be left from other prompts, as a model server keeps it across runs, so those are encoded in full
+        continues = [self.continues_prefix(prompt_ids) for prompt_ids in all_input_ids]
+        prefixed = [index for index, continued in enumerate(continues) if continued]
+        unprefixed = [index for index, continued in enumerate(continues) if not continued]
+        answers = [None] * len(all_input_ids)
+
+        for indices, score in [(prefixed, self.score_answers_with_prefix), (unprefixed, self.score_answers_without_prefix)]:
+            if indices:
+                for index, answer in zip(indices, score([all_input_ids[index] for index in indices])):
+                    answers[index] = answer
+
+        return answers
+
+    @torch.no_grad()
+    def score_answers_without_prefix(self, all_input_ids):
+        input_ids, attention_mask = self.pad_input_ids(all_input_ids)
+
+        if self.is_encoder_decoder():
+            decoder_input_ids = torch.full((input_ids.shape[0], 1), self.model.config.decoder_start_token_id, dtype=torch.long, device=self.device)
+            logits = self.model(input_ids=input_ids, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids).logits[:, 0, :]
+        else:
+            model_inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+
+            if self.accepts_position_ids():
+                model_inputs["position_ids"] = self.get_position_ids(attention_mask)
+
+            logits = self.model(**model_inputs).logits[:, -1, :]
+
+        return self.get_scored_answers(logits)
+
+    def generate_answers(self, prompts, max_tokens=1, temperature=0.5, top_k=20, top_p=0.95, do_sample=True, input_ids=None):
+        all_input_ids = self.tokenize(prompts, input_ids)
+
+        # assisted generation verifies the draft tokens of a single sequence at a time
+        if self.draft_model is not None:
+            return [answer for prompt_ids in all_input_ids for answer in self.generate_batch([prompt_ids], max_tokens, temperature, top_p, do_sample)]
+
+        return self.generate_batch(all_input_ids, max_tokens, temperature, top_p, do_sample)
+
+    @torch.no_grad()
+    def generate_batch(self, all_input_ids, max_tokens, temperature, top_p, do_sample):
+        input_ids, attention_mask = self.pad_input_ids(all_input_ids)
+        input_length = input_ids.shape[1]
+        # chain-of-thought generations are cut as soon as their answer is closed instead of running to max_tokens
+        stopping_criteria = StoppingCriteriaList([StopOnString(self.tokenizer, ANSWER_END_TAG, 0 if self.is_encoder_decoder() else input_length)])
+        generate_kwargs = {"assistant_model": self.draft_model} if self.draft_model is not None else {}
+        start = time.perf_counter()
+
+        with self.count_forward_passes():
+            outputs = self.model.generate(input_ids, attention_mask=attention_mask, pad_token_id=self.tokenizer.pad_token_id, max_new_tokens=max_tokens, temperature=temperature, top_p=top_p, do_sample=do_sample, num_return_sequences=1, min_new_tokens=1, early_stopping=True, return_dict_in_generate=True, output_scores=True, stopping_criteria=stopping_criteria, **generate_kwargs)
+
+        answers = self.get_scored_answers(outputs.scores[0])
         #output = decoded_output.split("Answer:")[-1][:3].strip()
-        #print(output, yes_logit_scores, no_logit_scores)
 
-        input_length = inputs.input_ids.shape[1]
-        if self.model_name in ["t5","flan-t5", "flan-alpaca", "mt0", "mt5"]:
-            generated_tokens = outputs.sequences[0]
+        if self.is_encoder_decoder():
+            generated_tokens = outputs.sequences
+        else:
+            generated_tokens = outputs.sequences[:, input_length:]
+
+        self.generation_stats["time"] += time.perf_counter() - start
+        # the decoder start token of encoder-decoder sequences was not generated
+        new_tokens = generated_tokens[:, 1:] if self.is_encoder_decoder() else generated_tokens
+        self.generation_stats["num_tokens"] += int((new_tokens != self.tokenizer.pad_token_id).sum())
+        self.generation_stats["num_sequences"] += len(all_input_ids)
+        decoded_outputs = self.tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)
+        return [{**answer, "generated_output": decoded_output} for answer, decoded_output in zip(answers, decoded_outputs)]
+
+    @contextlib.contextmanager
+    def count_forward_passes(self):
+        # every verification pass of the model keeps the accepted draft tokens plus one token of its own
+        handles = [self.model.register_forward_hook(lambda module, inputs, outputs: self.generation_stats.update(["target_forwards"]))]
+
+        if self.draft_model is not None:
+            # every draft forward pass proposes one candidate token
+            handles.append(self.draft_model.register_forward_hook(lambda module, inputs, outputs: self.generation_stats.update(["draft_forwards"])))
+
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def supports_continuous_batching(self):
+        # bloom caches keys as (batch * heads, dim, length), encoder-decoder models also cache their encoder outputs,
+        # and assisted generation verifies a single sequence at a time
+        return not self.is_encoder_decoder() and self.model_name != "bloomz7" and self.draft_model is None
+
+    @torch.no_grad()
+    def generate_stream(self, requests, batch_size, max_tokens=1, temperature=0.5, top_p=0.95, do_sample=True):
+        """Yields (key, answer) for (key, prompt, input_ids) requests as they finish, admitting new requests into the running batch."""
+        if not self.supports_continuous_batching():
+            yield from self.generate_static_stream(requests, batch_size, max_tokens=max_tokens, temperature=temperature, top_p=top_p, do_sample=do_sample)
+            return
+
+        requests = iter(requests)
+        generation = {"max_tokens": max_tokens, "temperature": temperature, "top_p": top_p, "do_sample": do_sample}
+        sequences = []
+        cache, attention_mask, next_tokens = None, None, None
+        exhausted = False
+
+        while True:
+            new_requests = []
+
+            while not exhausted and len(sequences) + len(new_requests) < batch_size:
+                request = next(requests, None)
+
+                if request is None:
+                    exhausted = True
+                else:
+                    new_requests.append(request)
+
+            if new_requests:
+                new_sequences, new_cache, new_mask, new_tokens, finished = self.start_sequences(new_requests, generation)
+                yield from finished
+                kept = [index for index, sequence in enumerate(new_sequences) if not sequence["finished"]]
+
+                if kept:
+                    new_cache, new_mask = self.select_sequences(new_cache, new_mask, kept)
+                    new_tokens = new_tokens[kept]
+
+                    if sequences:
+                        cache, attention_mask = self.concat_sequences(cache, attention_mask, new_cache, new_mask)
+                        next_tokens = torch.cat([next_tokens, new_tokens])
+                    else:
+                        cache, attention_mask, next_tokens = new_cache, new_mask, new_tokens
+
+                    sequences += [new_sequences[index] for index in kept]
+
+            if not sequences:
+                if exhausted:
+                    return
+
+                continue
+
+            start = time.perf_counter()
+            # every sequence feeds the token it sampled last, at the position following its own tokens
+            position_ids = attention_mask.sum(dim=1, keepdim=True)
+            attention_mask = torch.cat([attention_mask, torch.ones((len(sequences), 1), dtype=attention_mask.dtype, device=self.device)], dim=1)
+            outputs = self.model(input_ids=next_tokens[:, None], attention_mask=attention_mask, position_ids=position_ids, past_key_values=cache, use_cache=True)
+            cache = outputs.past_key_values
+            next_tokens, finished = self.advance_sequences(sequences, outputs.logits[:, -1, :], generation)
+            self.generation_stats["time"] += time.perf_counter() - start
+            self.generation_stats["steps"] += 1
+            self.generation_stats["sequence_steps"] += len(sequences)
+            yield from finished
+
+            if any(sequence["finished"] for sequence in sequences):
+                kept = [index for index, sequence in enumerate(sequences) if not sequence["finished"]]
+                sequences = [sequences[index] for index in kept]
+
+                if sequences:
+                    cache, attention_mask = self.select_sequences(cache, attention_mask, kept)
+                    next_tokens = next_tokens[kept]
+
+    @torch.no_grad()
+    def start_sequences(self, requests, generation):
+        start = time.perf_counter()
+        keys, prompts, all_input_ids = zip(*requests)
+        all_input_ids = [self.tokenize([prompt], None)[0] if input_ids is None else input_ids for prompt, input_ids in zip(prompts, all_input_ids)]
+        input_ids, attention_mask = self.pad_input_ids(all_input_ids)
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=self.get_position_ids(attention_mask), use_cache=True)
+        sequences = [{"key": key, "generated": [], "answer": None, "finished": False} for key in keys]
+        next_tokens, finished = self.advance_sequences(sequences, outputs.logits[:, -1, :], generation)
+        self.generation_stats["time"] += time.perf_counter() - start
+        return sequences, outputs.past_key_values, attention_mask, next_tokens, finished
+
+    def advance_sequences(self, sequences, logits, generation):
+        """Samples the next token of every sequence and returns them with the (key, answer) of the sequences finished by it."""
+        logits = logits.float()
+        first = torch.tensor([not sequence["generated"] for sequence in sequences], device=logits.device)
+        eos_token_ids = self.get_eos_token_ids()
+
+        # no sequence ends before its first token, as with min_new_tokens=1 in generate
+        if first.any() and eos_token_ids:
+            logits[first.nonzero(as_tuple=True)[0][:, None], torch.tensor(eos_token_ids, device=logits.device)] = -float("inf")
+
+        if generation["do_sample"]:
+            logits = self.get_logits_warpers(generation["temperature"], generation["top_p"])(None, logits)
+            next_tokens = torch.multinomial(torch.softmax(logits, dim=-1), 1).squeeze(-1)
         else:
-            generated_tokens = outputs.sequences[:, input_length:][0]
-        decoded_output = self.tokenizer.decode(generated_tokens, skip_special_tokens=True)
-        return proba_output, decoded_output
+            next_tokens = logits.argmax(dim=-1)
+
+        stop_criterion = StopOnString(self.tokenizer, ANSWER_END_TAG, 0)
+        finished = []
+
+        for index, (sequence, token) in enumerate(zip(sequences, next_tokens.tolist())):
+            # the answer is scored on the processed logits of the first token, as the scores returned by generate
+            if sequence["answer"] is None:
+                sequence["answer"] = self.get_scored_answers(logits[index:index + 1])[0]
+
+            sequence["generated"].append(token)
+
+            if token in eos_token_ids or len(sequence["generated"]) >= generation["max_tokens"] or stop_criterion(torch.tensor([sequence["generated"]]), None)[0]:
+                sequence["finished"] = True
+                self.generation_stats["num_tokens"] += len(sequence["generated"]) - (token in eos_token_ids)
+                self.generation_stats["num_sequences"] += 1
+                finished.append((sequence["key"], {**sequence["answer"], "generated_output": self.tokenizer.decode(sequence["generated"], skip_special_tokens=True)}))
+
+        return next_tokens, finished
+
+    def get_eos_token_ids(self):
+        eos_token_id = self.model.generation_config.eos_token_id
+
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+
+        return [] if eos_token_id is None else eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+
+    def get_logits_warpers(self, temperature, top_p):
+        # same warpers in the same order as sampling in generate
+        return LogitsProcessorList([TemperatureLogitsWarper(temperature), TopKLogitsWarper(self.model.generation_config.top_k or 50), TopPLogitsWarper(top_p)])
+
+    def get_cache_layers(self, cache):
+        if hasattr(cache, "layers"):
+            return [(layer.keys, layer.values) for layer in cache.layers]
+
+        if hasattr(cache, "to_legacy_cache"):
+            return list(cache.to_legacy_cache())
+
+        return list(cache)
+
+    def make_cache(self, layers):
+        if DynamicCache is None:
+            return tuple(layers)
+
+        if hasattr(DynamicCache, "from_legacy_cache"):
+            return DynamicCache.from_legacy_cache(tuple(layers))
+
+        cache = DynamicCache()
+
+        for layer_index, (keys, values) in enumerate(layers):
+            cache.update(keys, values, layer_index)
+
+        return cache
+
+    def select_sequences(self, cache, attention_mask, indices):
+        # the leading positions that only padded the dropped sequences are dropped with them
+        attention_mask = attention_mask[indices]
+        start = int(attention_mask.any(dim=0).long().argmax())
+        layers = [(keys[indices, :, start:], values[indices, :, start:]) for keys, values in self.get_cache_layers(cache)]
+        return self.make_cache(layers), attention_mask[:, start:]
+
+    def concat_sequences(self, cache, attention_mask, other_cache, other_mask):
+        # both groups are left-padded to the same length, the masked positions are never attended to
+        length = max(attention_mask.shape[1], other_mask.shape[1])
+        pad = lambda tensor, tensor_length: torch.nn.functional.pad(tensor, (0, 0, length - tensor_length, 0))
+        layers = [(torch.cat([pad(keys, attention_mask.shape[1]), pad(other_keys, other_mask.shape[1])]), torch.cat([pad(values, attention_mask.shape[1]), pad(other_values, other_mask.shape[1])])) for (keys, values), (other_keys, other_values) in zip(self.get_cache_layers(cache), self.get_cache_layers(other_cache))]
+        attention_mask = torch.cat([torch.nn.functional.pad(attention_mask, (length - attention_mask.shape[1], 0)), torch.nn.functional.pad(other_mask, (length - other_mask.shape[1], 0))])
+        return self.make_cache(layers), attention_mask
+
+    def generate_static_stream(self, requests, batch_size, **generate_kwargs):
+        requests = iter(requests)
+
+        for batch in iter(lambda: list(itertools.islice(requests, batch_size)), []):
+            keys, prompts, all_input_ids = zip(*batch)
+            input_ids = None if any(ids is None for ids in all_input_ids) else list(all_input_ids)
+            yield from zip(keys, self.generate_answers(list(prompts), input_ids=input_ids, **generate_kwargs))
+
+    def get_generation_stats(self):
+        return dict(self.generation_stats)
+
+    def reset_generation_stats(self):
+        self.generation_stats.clear()
+
+def pack_batches(lengths, batch_size, max_batch_tokens=None):
+    """Groups indices of prompts of similar length into batches of at most batch_size prompts and max_batch_tokens padded tokens."""
+    order = sorted(range(len(lengths)), key=lambda index: lengths[index], reverse=True)
+    batches = []
+    batch = []
+
+    for index in order:
+        # prompts come longest first, so the first prompt of a batch sets its padded length
+        if batch and (len(batch) == batch_size or (max_batch_tokens is not None and (len(batch) + 1) * lengths[batch[0]] > max_batch_tokens)):
+            batches.append(batch)
+            batch = []
+
+        batch.append(index)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+def score_sample(sample, res_dict, predictions, references, scores_per_situation):
+    ref = 1 if sample["answer"].strip().lower() == "yes" else 0
+    references.append(ref)
+
+    for method, response in res_dict.items():
+        label = 0
+
+        if method == "generated_output" and sample["type"] in COT_TEMPLATES:
+            # the reasoning is kept as generated for report_metrics, only the tagged answer is scored
+            sample[method] = response.strip()
+            answer = get_cot_answer(response)
+        else:
+            sample[method] = response.strip().lower()
+            answer = sample[method]
+
+        # sample can be correct only if yes or no is generated
+        if answer in ["yes", "no"]:
+            pred = 1 if answer == "yes" else 0
+            sample["correct_"+method] = ref == pred
+        else:
+            pred = 2
+            sample["correct_"+method] = 0
+        
+        predictions[method].append(pred)
+
+        if sample["correct_"+method] == True: 
+            label = 1 
+        else: 
+            label = 0 
+
+        if sample["data_id"] in scores_per_situation[method]: 
+            scores_per_situation[method][sample["data_id"]].append(label)
+        else: 
+            scores_per_situation[method][sample["data_id"]] = [label]
+
+def get_cot_answer(response):
+    match = re.search("<Answer>(?P<pred>.*?)</Answer>", response)
+    return match["pred"].strip().lower() if match else None
+
+def summarize_generation(stats):
+    """Adds the throughput and the draft acceptance rate estimated from the forward passes counted during generation."""
+    summary = dict(stats)
+    summary["tokens_per_second"] = stats.get("num_tokens", 0) / stats["time"] if stats.get("time") else None
+    summary["acceptance_rate"] = None
+
+    if stats.get("steps"):
+        summary["mean_batch_size"] = stats["sequence_steps"] / stats["steps"]
+
+    if stats.get("draft_forwards"):
+        # every verification pass yields one token of the model, the other generated tokens are accepted draft tokens
+        summary["acceptance_rate"] = max(stats["num_tokens"] - stats["target_forwards"], 0) / stats["draft_forwards"]
+
+    return summary
+
+def measure_static_generation(model, samples, args, token_cache=None):
+    """Generates the prompts of samples again in static batches, for the throughput of continuous batching to be compared against."""
+    model.reset_generation_stats()
+    requests = [(sample["instance_id"], get_prompt(sample), token_cache.get_input_ids([sample["instance_id"]])[0] if token_cache is not None else None) for sample in samples]
+
+    for _ in tqdm(model.generate_static_stream(requests, args.batch_size, max_tokens=args.max_tokens, temperature=args.temperature, top_p=args.top_p, do_sample=args.do_sample), total=len(requests)):
+        pass
+
+    return summarize_generation(model.get_generation_stats())
+
+def get_prompt(sample):
+    # option labels directly follow the "Answer:" of mcq prompts
+    return sample["prompt"] if sample["type"] == "mcq" else sample["prompt"]+'.'
+
+def get_options(sample):
+    return [str(index+1) for index in range(sample["num_options"])]
+
+def score_mcq_sample(sample, option_scores, args):
+    gold_answers = [int(a) for a in sample["answer"].split(",") if a.strip()]
+    refs = [1 if i+1 in gold_answers else 0 for i in range(sample["num_options"])]
+    # options are compared by their probability among the options of the instance
+    prob_scores = torch.softmax(torch.tensor(option_scores, dtype=torch.double), dim=0).tolist()
+    # the number of gold options is only used when asked for, since it gives the reference away to the prediction
+    num_positive = len(gold_answers) if args.mcq_gold_num_positive else args.mcq_num_positive
+    preds = predict_with_strategy(prob_scores, strategy=args.mcq_strategy, num_positive=num_positive)
+
+    sample["option_scores"] = option_scores
+    sample["references"] = refs
+    sample["predictions"] = preds
+    sample["accuracy"] = accuracy_score(refs, preds)
+    sample["precision"] = precision_score(refs, preds, average="macro")
+    sample["recall"] = recall_score(refs, preds, average="macro")
+    sample["f1"] = f1_score(refs, preds, average="macro")
+
+def get_methods(args):
+    return ["highest_proba", "generated_output"] if args.generate else ["highest_proba"]
+
+def get_generation_params(args, seed, calibration=None):
+    # cached answers hold yes/no decisions with the biases of contextual calibration already applied,
+    # so answers of uncalibrated runs or of other biases must not be read back
+    biases = calibration["biases"] if calibration is not None else None
+
+    # scoring reads the logits of a single forward pass, which no generation parameter affects,
+    # but the logits themselves depend on the precision the weights were loaded in
+    if not args.generate:
+        return {"scoring": "logits", "precision": args.precision, "calibration": biases}
+
+    params = {
+        "precision": args.precision,
+        "calibration": biases,
+        "temperature": args.temperature,
+        "max_tokens": args.max_tokens,
+        "top_p": args.top_p,
+        "do_sample": args.do_sample
+    }
+
+    # sampled outputs are only reproducible under the same seed
+    if args.do_sample:
+        params["seed"] = seed
+
+    return params
+
+def get_stopping_method(args):
+    # generated runs are reported by their generated output, whose yes/no comes after any reasoning,
+    # while highest_proba only scores the first generated token
+    return "generated_output" if args.generate else "highest_proba"
+
+def track_stopping(stopper, sample, predictions, references, method):
+    ref = references[-1]
+    pred = predictions[method][-1]
+
+    # answers other than yes/no count as wrong, as in the final metrics
+    if pred == 2:
+        pred = 1 - ref
+
+    stopper.add(sample["data_id"], ref, pred)
+
+def generate_window(model, samples, args, cache=None, cache_params=None, token_cache=None):
+    prompts = [get_prompt(sample) for sample in samples]
+    answers = [None] * len(samples)
+    uncached = []
+
+    for index, (sample, prompt) in enumerate(zip(samples, prompts)):
+        if sample["type"] == "mcq":
+            # all options of an instance already share one batch, so mcq instances are scored one by one
+            options = get_options(sample)
+            mcq_params = {"scoring": "options", "options": options, "precision": args.precision}
+            cached = cache.get("hf", args.model, prompt, mcq_params) if cache is not None else None
+
+            if cached is None:
+                context_ids = token_cache.get_input_ids([sample["instance_id"]])[0] if token_cache is not None else None
+                answers[index] = {"option_scores": model.score_options(prompt, options, context_ids=context_ids)}
+            else:
+                answers[index] = cached
+
+            if cache is not None and cached is None:
+                cache.put("hf", args.model, prompt, mcq_params, answers[index])
+
+            continue
+
+        cached = cache.get("hf", args.model, prompt, cache_params) if cache is not None else None
+
+        if cached is not None:
+            answers[index] = cached
+        else:
+            uncached.append(index)
+
+    if token_cache is not None:
+        # lengths are read from the cache, so batches are packed without tokenizing the prompts again
+        lengths = token_cache.get_lengths([samples[index]["instance_id"] for index in uncached])
+    else:
+        lengths = model.get_prompt_lengths([prompts[index] for index in uncached]) if len(uncached) > 1 else [0] * len(uncached)
+
+    for batch in pack_batches(lengths, args.batch_size, args.max_batch_tokens):
+        indices = [uncached[position] for position in batch]
+        batch_prompts = [prompts[index] for index in indices]
+        input_ids = token_cache.get_input_ids([samples[index]["instance_id"] for index in indices]) if token_cache is not None else None
+
+        if args.generate:
+            batch_answers = model.generate_answers(batch_prompts, temperature=args.temperature, max_tokens=args.max_tokens, top_p=args.top_p, do_sample=args.do_sample, input_ids=input_ids)
+        else:
+            batch_answers = model.score_answers(batch_prompts, input_ids=input_ids)
+
+        for index, answer in zip(indices, batch_answers):
+            answers[index] = answer
+
+            if cache is not None:
+                cache.put("hf", args.model, prompts[index], cache_params, answer)
+
+    return answers
+
+def stream_answers(model, samples, args, cache=None, cache_params=None, token_cache=None):
+    """Yields (instance_id, answer) of all samples, generating the uncached ones in one continuously refilled batch."""
+    prompts = {}
+
+    for sample in samples:
+        prompt = get_prompt(sample)
+        cached = cache.get("hf", args.model, prompt, cache_params) if cache is not None else None
+
+        if cached is not None:
+            yield sample["instance_id"], cached
+        else:
+            prompts[sample["instance_id"]] = prompt
+
+    # input ids are read from the token cache only when a request joins the batch
+    requests = ((instance_id, prompt, token_cache.get_input_ids([instance_id])[0] if token_cache is not None else None) for instance_id, prompt in prompts.items())
+
+    for instance_id, answer in model.generate_stream(requests, args.batch_size, max_tokens=args.max_tokens, temperature=args.temperature, top_p=args.top_p, do_sample=args.do_sample):
+        if cache is not None:
+            cache.put("hf", args.model, prompts[instance_id], cache_params, answer)
+
+        yield instance_id, answer
+
+def wait_for_answers(stream, finished, instance_ids):
+    # answers arrive in the order generations finish, so those of later windows are kept until their window is scored
+    while any(instance_id not in finished for instance_id in instance_ids):
+        instance_id, answer = next(stream)
+        finished[instance_id] = answer
+
+    return {instance_id: finished.pop(instance_id) for instance_id in instance_ids}
+
+def evaluate_samples(model, data, journal, journal_records, args, predictions, references, scores_per_situation, cache=None, cache_params=None, stopper=None, token_cache=None):
+    methods = get_methods(args)
+    window_size = args.batch_size * SORT_WINDOW_BATCHES if args.batch_size > 1 else 1
+    progress_bar = tqdm(total=len(data))
+    stream = None
+    finished = {}
+
+    if args.continuous_batching and model is not None:
+        stream = stream_answers(model, [sample for sample in data if sample["instance_id"] not in journal_records], args, cache=cache, cache_params=cache_params, token_cache=token_cache)
+
+    for start in range(0, len(data), window_size):
+        if stopper is not None and stopper.stopped:
+            break
+
+        window = data[start:start + window_size]
+        pending = [sample for sample in window if sample["instance_id"] not in journal_records]
+
+        if stream is not None:
+            answers = wait_for_answers(stream, finished, [sample["instance_id"] for sample in pending])
+        else:
+            answers = dict(zip([sample["instance_id"] for sample in pending], generate_window(model, pending, args, cache=cache, cache_params=cache_params, token_cache=token_cache)))
+
+        # samples are scored in data order, so results do not depend on how the window was batched
+        for sample in window:
+            if stopper is not None and stopper.stopped:
+                break
+
+            if sample["instance_id"] in journal_records:
+                sample.update(journal_records[sample["instance_id"]])
+
+                if sample["type"] != "mcq":
+                    score_sample(sample, {method: sample[method] for method in methods}, predictions, references, scores_per_situation)
+            elif sample["type"] == "mcq":
+                score_mcq_sample(sample, answers[sample["instance_id"]]["option_scores"], args)
+                journal.record(sample)
+            else:
+                answer = answers[sample["instance_id"]]
+
+                if "probabilities" in answer:
+                    sample["probabilities"] = answer["probabilities"]
+
+                score_sample(sample, {method: answer[method] for method in methods}, predictions, references, scores_per_situation)
+                journal.record(sample)
+
+            if stopper is not None:
+                track_stopping(stopper, sample, predictions, references, get_stopping_method(args))
+
+            progress_bar.update(1)
+
+    progress_bar.close()
+
+def calibrate_model(model, args, data):
+    calibration_path = get_calibration_path(args.calibration_dir, args.model, pathlib.Path(args.datapath).stem)
+    biases = load_biases(calibration_path, model.precision)
+
+    if biases is None:
+        biases = model.calibrate(get_content_free_prompts(get_prompt(data[0])))
+        save_biases(calibration_path, biases, model.precision)
+        print(f"Calibrated yes/no biases {biases} written to {calibration_path}")
+    else:
+        model.set_letters_biases(biases)
+        print(f"Calibrated yes/no biases {biases} loaded from {calibration_path}")
+
+    return {"path": calibration_path, "biases": biases}
+
+def load_token_cache(args, data):
+    if args.no_token_cache:
+        return None
+
+    # the tokenizer alone is loaded, so the cache is built once before any worker or server loads the model
+    engine = MODELS_MAP[args.model]
+    tokenizer = AutoTokenizer.from_pretrained(engine)
+    token_cache = get_token_cache(args.datapath, [sample["instance_id"] for sample in data], [get_prompt(sample) for sample in data], tokenizer, engine, cache_dir=args.token_cache_dir, num_proc=args.tokenize_workers)
+    print(f"Token cache of {args.datapath} loaded from {token_cache.path}")
+    return token_cache
+
+def load_model(args, data, token_cache=None):
+    if args.server_url is not None:
+        model = ModelClient(args.server_url)
+
+        if model.get_model_name() != args.model:
+            raise ValueError(f"Model server {args.server_url} serves {model.get_model_name()}, not {args.model}.")
+
+        if model.draft_model_name != args.draft_model:
+            raise ValueError(f"Model server {args.server_url} drafts with {model.draft_model_name}, not {args.draft_model}.")
+    else:
+        model = ModelWrapper(args.model, precision=args.precision, weights_cache_dir=args.weights_cache_dir, draft_model_name=args.draft_model)
+
+    # a model server keeps the generation statistics of the previous run otherwise
+    model.reset_generation_stats()
+
+    shared_prefix_tokens = 0
+    calibration = None
+
+    if not args.no_calibration and data and not any(sample["type"] == "mcq" for sample in data):
+        calibration = calibrate_model(model, args, data)
+    else:
+        # a model server keeps the biases of the previous run otherwise
+        model.set_letters_biases({})
+
+    if not args.generate and not args.no_prefix_cache:
+        input_ids = token_cache.get_input_ids([sample["instance_id"] for sample in data]) if token_cache is not None else None
+        shared_prefix_tokens = model.set_shared_prefix([get_prompt(sample) for sample in data], input_ids=input_ids)
+        print(f"Sharing a prefix of {shared_prefix_tokens} tokens across prompts")
+    else:
+        # a model server keeps the prefix of the previous run otherwise
+        model.set_shared_prefix([])
+
+    return model, {"shared_prefix_tokens": shared_prefix_tokens, "calibration": calibration}
+
+def shard_by_group(data, num_shards, group_attr="data_id"):
+    """Splits samples into num_shards shards of similar size without splitting any group, keeping the data order within shards."""
+    groups = defaultdict(list)
+
+    for index, sample in enumerate(data):
+        groups[sample[group_attr]].append(index)
+
+    shards = [[] for _ in range(num_shards)]
+
+    for indices in sorted(groups.values(), key=len, reverse=True):
+        min(shards, key=len).extend(indices)
+
+    return [[data[index] for index in sorted(shard)] for shard in shards]
+
+def split_cores(num_workers):
+    # contiguous ranges keep each worker on as few sockets as possible with the usual core numbering
+    cores = sorted(os.sched_getaffinity(0))
+
+    if num_workers > len(cores):
+        raise ValueError(f"Cannot pin {num_workers} workers to {len(cores)} cores.")
+
+    return [cores[len(cores) * index // num_workers:len(cores) * (index + 1) // num_workers] for index in range(num_workers)]
+
+def evaluate_shard(shard, cores, journal_path, args, seed, token_cache_path=None):
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    set_seed(seed)
+
+    methods = get_methods(args)
+    predictions = {method: [] for method in methods}
+    scores_per_situation = {method: {} for method in methods}
+    token_cache = TokenCache(token_cache_path) if token_cache_path is not None else None
+    model, model_info = load_model(args, shard, token_cache)
+    cache = ResponseCache(args.cache_path, max_size=args.cache_max_size) if args.cache_path is not None else None
+    journal = RunJournal(journal_path, sync_every=args.sync_every)
+    journal.open()
+
+    try:
+        evaluate_samples(model, shard, journal, {}, args, predictions, [], scores_per_situation, cache=cache, cache_params=get_generation_params(args, seed, model_info["calibration"]), token_cache=token_cache)
+    finally:
+        journal.close()
+
+        if cache is not None:
+            cache.close()
+
+    return {
+        "cores": cores,
+        "num_instances": len(shard),
+        "shared_prefix_tokens": model_info["shared_prefix_tokens"],
+        "calibration": model_info["calibration"],
+        "load_time": model.load_time,
+        "generation": model.get_generation_stats() if args.generate else None,
+        "cache": cache.stats() if cache is not None else None
+    }
+
+def evaluate_sharded(data, journal_path, args, seed, token_cache_path=None):
+    shards = shard_by_group(data, args.num_workers)
+    cores = split_cores(args.num_workers)
+    print(f"Evaluating {len(data)} instances with {args.num_workers} workers")
+
+    # every worker holds its own model replica, so each task runs in a fresh process
+    with multiprocessing.get_context("spawn").Pool(args.num_workers, maxtasksperchild=1) as pool:
+        return pool.starmap(evaluate_shard, [(shard, cores[index], get_shard_journal_path(journal_path, index), args, seed, token_cache_path) for index, shard in enumerate(shards)], chunksize=1)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -101,6 +1058,33 @@ def main():
     parser.add_argument("--num-samples", type=int, help="Number of samples to evaluate", default=0)
     parser.add_argument("--seed", type=int, default=None, help="Seed for reproducibility.")
     parser.add_argument("--do-sample", action="store_true", default=False, help="Whether to do sampling")
+    parser.add_argument("--no-prefix-cache", action="store_true", default=False, help="Encode every prompt in full instead of reusing the keys and values of the prefix shared by all prompts")
+    parser.add_argument("--generate", action="store_true", default=False, help="Also generate an answer for generated_output instead of only scoring the yes/no logits of one forward pass")
+    parser.add_argument("--resume", type=str, default=None, help="Path to the run journal (.jsonl) of an interrupted run to resume")
+    parser.add_argument("--sync-every", type=int, default=50, help="Number of finished instances between journal fsyncs")
+    parser.add_argument("--ci-half-width", type=float, default=None, help="Stop once the bootstrap confidence interval of macro-F1 is at most this half-width, of generated_output with --generate (evaluates everything if not given)")
+    parser.add_argument("--ci-confidence", type=float, default=0.95, help="Confidence level of the stopping interval")
+    parser.add_argument("--ci-min-groups", type=int, default=30, help="Minimum number of finished data_id groups before the stopping rule is checked")
+    parser.add_argument("--ci-check-every", type=int, default=25, help="Number of finished data_id groups between checks of the stopping rule")
+    parser.add_argument("--cache-path", type=str, default=None, help="Path to the SQLite response cache shared across runs (disabled if not given)")
+    parser.add_argument("--cache-max-size", type=int, default=2 * 1024 ** 3, help="Maximum size of the response cache in bytes")
+    parser.add_argument("--precision", type=str, choices=PRECISIONS, default="fp32", help="Weights precision on CPU, bf16 loads bfloat16 weights and int8-dynamic quantizes the linear layers")
+    parser.add_argument("--weights-cache-dir", type=str, default=WEIGHTS_CACHE_DIR, help="Directory of the safetensors conversions of local .bin checkpoints")
+    parser.add_argument("--server-url", type=str, default=None, help="URL of a model_server.py process serving --model, used instead of loading the model")
+    parser.add_argument("--num-workers", type=int, default=1, help="Number of worker processes, each with its own model replica pinned to a share of the cores")
+    parser.add_argument("--no-calibration", action="store_true", default=False, help="Take raw yes/no decisions instead of correcting them with the biases of content-free prompts")
+    parser.add_argument("--calibration-dir", type=str, default="calibration", help="Directory of the yes/no biases stored per model and template")
+    parser.add_argument("--mcq-strategy", type=str, choices=["top_k", "threshold"], default="top_k", help="How option probabilities of mcq templates are turned into predictions")
+    parser.add_argument("--mcq-num-positive", type=int, default=1, help="Number of options predicted by top_k, or the threshold numerator over the number of options, for mcq templates")
+    parser.add_argument("--mcq-gold-num-positive", action="store_true", default=False, help="Take the number of gold options of each instance as --mcq-num-positive, an oracle that reads the reference and only bounds mcq metrics from above")
+    parser.add_argument("--batch-size", type=int, default=1, help="Maximum number of prompts generated together, prompts are sorted by length and padded")
+    parser.add_argument("--max-batch-tokens", type=int, default=None, help="Maximum number of padded prompt tokens in a batch (only --batch-size applies if not given)")
+    parser.add_argument("--draft-model", type=str, choices=list(MODELS_MAP), default=None, help="Small model sharing the tokenizer of --model, whose proposed tokens --model verifies in assisted generation")
+    parser.add_argument("--continuous-batching", action="store_true", default=False, help="Generate with a batch of --batch-size prompts that admits a new prompt as soon as another one finishes (falls back to static batches for bloom and encoder-decoder models)")
+    parser.add_argument("--compare-sequential", action="store_true", default=False, help="Generate the evaluated prompts again in static batches afterwards and report both throughputs")
+    parser.add_argument("--no-token-cache", action="store_true", default=False, help="Tokenize prompts at every run instead of reading them from the Arrow cache of the eval file")
+    parser.add_argument("--token-cache-dir", type=str, default=TOKEN_CACHE_DIR, help="Directory of the tokenized eval files stored per data file and tokenizer")
+    parser.add_argument("--tokenize-workers", type=int, default=4, help="Number of processes tokenizing an eval file missing from the token cache")
     
     args = parser.parse_args()
 
@@ -111,45 +1095,106 @@ def main():
 
     set_seed(seed)
 
+    if args.num_workers > 1 and args.ci_half_width is not None:
+        raise ValueError("Sequential stopping with --ci-half-width needs a single worker.")
+
+    if args.draft_model is not None and not args.generate:
+        raise ValueError("A draft model only speeds up generation, use it with --generate.")
+
+    if (args.continuous_batching or args.compare_sequential) and not args.generate:
+        raise ValueError("Continuous batching schedules generation, use it with --generate.")
+
+    if args.compare_sequential and args.num_workers > 1:
+        raise ValueError("--compare-sequential needs the model in the main process, use it with --num-workers 1.")
+
+    if args.num_workers > 1 and args.server_url is not None:
+        raise ValueError("A model server holds a single model replica, use --num-workers 1 with --server-url.")
+
     data = read_json(args.datapath)
+    # the whole file is tokenized, so runs on fewer samples share its cache
+    token_cache = load_token_cache(args, data)
 
     if args.num_samples > 0:
         data = data[:int(args.num_samples)]
 
-    predictions = {"highest_proba": [], "generated_output": []}
+    is_mcq = any(sample["type"] == "mcq" for sample in data)
+
+    if args.mcq_gold_num_positive and args.mcq_num_positive != 1:
+        raise ValueError("--mcq-gold-num-positive replaces --mcq-num-positive, give only one of them.")
+
+    if is_mcq and (args.generate or args.ci_half_width is not None):
+        raise ValueError("mcq templates are scored by option likelihood, which supports neither --generate nor --ci-half-width.")
+
+    stopper = None
+
+    if args.ci_half_width is not None:
+        data = stratified_group_order(data, seed=seed)
+        stopper = SequentialStopper(Counter(sample["data_id"] for sample in data), args.ci_half_width, confidence=args.ci_confidence, min_groups=args.ci_min_groups, check_every=args.ci_check_every, seed=seed)
+
+    methods = get_methods(args)
+    predictions = {method: [] for method in methods}
     references = []
-    scores_per_situation = {"highest_proba": {}, "generated_output": {}}
+    scores_per_situation = {method: {} for method in methods}
+
+    pathlib.Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    datapath = pathlib.Path(args.datapath)
 
-    model = ModelWrapper(args.model)
+    if args.resume is not None:
+        journal_path = args.resume
+        output_path = get_output_path(journal_path)
+    else:
+        output_path = os.path.join(args.output_dir, f"{datapath.stem}_{args.model}_{generate_unique_id()}.json")
+        journal_path = get_journal_path(output_path)
 
-    for sample in tqdm(data, total=len(data)):
-        proba_output, decoded_output = model.generate_answer(sample["prompt"]+'.', temperature=args.temperature, max_tokens=args.max_tokens, top_p=args.top_p, do_sample=args.do_sample)
-        ref = 1 if sample["answer"].strip().lower() == "yes" else 0
-        references.append(ref)
-        res_dict = {"highest_proba": proba_output, "generated_output": decoded_output}
+    journal = RunJournal(journal_path, sync_every=args.sync_every)
+    journal_records = {}
 
-        for method, response in res_dict.items():
-            label = 0
-            sample[method] = response.strip().lower()
-            # sample can be correct only if yes or no is generated
-            if sample[method] in ["yes", "no"]:
-                pred = 1 if response.strip().lower() == "yes" else 0
-                sample["correct_"+method] = ref == pred
-            else:
-                pred = 2
-                sample["correct_"+method] = 0
-            
-            predictions[method].append(pred)
+    if args.resume is not None:
+        journal_records = journal.load()
+        journal_records.update(load_shard_journals(journal_path))
 
-            if sample["correct_"+method] == True: 
-                label = 1 
-            else: 
-                label = 0 
+    if journal_records:
+        print(f"Resuming from {journal_path} with {len(journal_records)} instances already evaluated")
 
-            if sample["data_id"] in scores_per_situation[method]: 
-                scores_per_situation[method][sample["data_id"]].append(label)
-            else: 
-                scores_per_situation[method][sample["data_id"]] = [label]
+    workers = None
+
+    if args.num_workers > 1:
+        pending = [sample for sample in data if sample["instance_id"] not in journal_records]
+        workers = evaluate_sharded(pending, journal_path, args, seed, token_cache.path if token_cache is not None else None) if pending else []
+        journal_records.update(load_shard_journals(journal_path))
+        num_missing = sum(1 for sample in data if sample["instance_id"] not in journal_records)
+
+        if num_missing > 0:
+            raise ValueError(f"{num_missing} instances were not evaluated by the workers, resume with --resume {journal_path}")
+
+        # the merged shard journals cover every instance, so the run below only scores them
+        model = None
+        model_info = {
+            "shared_prefix_tokens": min((worker["shared_prefix_tokens"] for worker in workers), default=0),
+            "calibration": workers[0]["calibration"] if workers else None
+        }
+        load_time = max((worker["load_time"] for worker in workers), default=None)
+        generation_stats = sum((Counter(worker["generation"]) for worker in workers if worker["generation"] is not None), Counter())
+    else:
+        model, model_info = load_model(args, data, token_cache)
+        load_time = model.load_time
+
+    if args.server_url is not None:
+        args.precision = model.precision
+
+    cache = ResponseCache(args.cache_path, max_size=args.cache_max_size) if args.cache_path is not None else None
+    journal.open()
+
+    try:
+        evaluate_samples(model, data, journal, journal_records, args, predictions, references, scores_per_situation, cache=cache, cache_params=get_generation_params(args, seed, model_info["calibration"]), stopper=stopper, token_cache=token_cache)
+    finally:
+        journal.close()
+
+        if cache is not None:
+            cache.close()
+
+    if model is not None:
+        generation_stats = model.get_generation_stats()
 
     outputs = {
         "metadata": {
@@ -159,7 +1204,18 @@ def main():
             "max_tokens": args.max_tokens,
             "top_p": args.top_p,
             "seed": seed,
-            "do_sample": args.do_sample
+            "do_sample": args.do_sample,
+            "generate": args.generate,
+            "precision": args.precision,
+            "shared_prefix_tokens": model_info["shared_prefix_tokens"],
+            "calibration": model_info["calibration"],
+            "batch_size": args.batch_size,
+            "max_batch_tokens": args.max_batch_tokens,
+            "num_workers": args.num_workers,
+            "server_url": args.server_url,
+            "load_time": load_time,
+            "token_cache": token_cache.path if token_cache is not None else None,
+            "draft_model": args.draft_model
         },
         "metrics_highest_proba": {
             "accuracy": 0,
@@ -176,9 +1232,49 @@ def main():
         "data": data
     }
 
-    outputs["metrics_generated_output"]["part_without_yes_no"] = sum([elem == 2 for elem in predictions["generated_output"]])/len(predictions["generated_output"])
+    if cache is not None:
+        outputs["metadata"]["cache"] = cache.stats()
 
-    for method in ["highest_proba", "generated_output"]:
+    if workers is not None:
+        outputs["metadata"]["workers"] = workers
+
+    if stopper is not None:
+        outputs["metadata"]["sequential"] = stopper.stats()
+        outputs["metadata"]["sequential"]["method"] = get_stopping_method(args)
+
+    if args.generate:
+        outputs["metadata"]["generation"] = summarize_generation(generation_stats)
+        outputs["metadata"]["generation"]["continuous_batching"] = args.continuous_batching
+
+    if args.compare_sequential:
+        generated_samples = [sample for sample in data if "generated_output" in sample]
+        print(f"Generating {len(generated_samples)} instances again in static batches")
+        static = measure_static_generation(model, generated_samples, args, token_cache)
+        outputs["metadata"]["generation"]["static"] = static
+
+        if static["tokens_per_second"] and outputs["metadata"]["generation"]["tokens_per_second"]:
+            outputs["metadata"]["generation"]["speedup"] = outputs["metadata"]["generation"]["tokens_per_second"] / static["tokens_per_second"]
+
+    if is_mcq:
+        # mcq instances carry their own metrics over their options, as in evaluate_gpt
+        outputs["metadata"]["mcq_strategy"] = args.mcq_strategy
+        outputs["metadata"]["mcq_num_positive"] = args.mcq_num_positive
+        outputs["metadata"]["mcq_gold_num_positive"] = args.mcq_gold_num_positive
+        del outputs["metrics_highest_proba"]
+        del outputs["metrics_generated_output"]
+        methods = []
+        outputs["metrics"] = {
+            "accuracy": np.mean([sample["accuracy"] for sample in data if "accuracy" in sample]),
+            "precision": np.mean([sample["precision"] for sample in data if "precision" in sample]),
+            "recall": np.mean([sample["recall"] for sample in data if "recall" in sample]),
+            "f1": np.mean([sample["f1"] for sample in data if "f1" in sample])
+        }
+    elif args.generate:
+        outputs["metrics_generated_output"]["part_without_yes_no"] = sum([elem == 2 for elem in predictions["generated_output"]])/len(predictions["generated_output"])
+    else:
+        del outputs["metrics_generated_output"]
+
+    for method in methods:
         for i in range(len(predictions[method])):
             if predictions[method][i] == 2:
                 predictions[method][i] = 1 if references[i] == 0 else 0
@@ -193,9 +1289,6 @@ def main():
                 count +=1
         outputs["metrics_"+method]["exact_match"]= (len(scores_per_situation[method]) - count)/len(scores_per_situation[method])
 
-    pathlib.Path(args.output_dir).mkdir(parents=True, exist_ok=True)
-    datapath = pathlib.Path(args.datapath)
-    output_path = os.path.join(args.output_dir, f"{datapath.stem}_{args.model}_{generate_unique_id()}.json")
     print(f"Writing to {output_path}")
     write_json(outputs, output_path)
 
@@ -0,0 +1,74 @@
+import json
+import os
+import glob
+
+def get_journal_path(output_path):
+    return os.path.splitext(output_path)[0] + ".jsonl"
+
+def get_output_path(journal_path):
+    return os.path.splitext(journal_path)[0] + ".json"
+
+def get_shard_journal_path(journal_path, shard_index):
+    return os.path.splitext(journal_path)[0] + f"_shard{shard_index}.jsonl"
+
+def load_shard_journals(journal_path):
+    records = {}
+
+    for shard_journal_path in sorted(glob.glob(glob.escape(os.path.splitext(journal_path)[0]) + "_shard*.jsonl")):
+        records.update(RunJournal(shard_journal_path).load())
+
+    return records
+
+class RunJournal():
+    """Append-only JSONL log with one line per finished instance, used to resume interrupted runs."""
+
+    def __init__(self, path, sync_every=50):
+        self.path = path
+        self.sync_every = sync_every
+        self.num_unsynced = 0
+        self.file = None
+
+    def load(self):
+        records = {}
+
+        if not os.path.exists(self.path):
+            return records
+
+        with open(self.path, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # the last line was torn by a crash before it was synced
+                    break
+
+                record = json.loads(line)
+                records[record["instance_id"]] = record
+
+        return records
+
+    def open(self):
+        if os.path.exists(self.path):
+            # drop a torn trailing line so that new records start on a fresh line
+            with open(self.path, "rb+") as f:
+                content = f.read()
+                if content and not content.endswith(b"\n"):
+                    f.truncate(content.rfind(b"\n") + 1)
+
+        self.file = open(self.path, "a")
+
+    def record(self, sample):
+        self.file.write(json.dumps(sample) + "\n")
+        self.num_unsynced += 1
+
+        if self.num_unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.num_unsynced = 0
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
@@ -0,0 +1,45 @@
+import numpy as np
+
+# cells of the last axis of confusion counts, indexed by 2 * reference + prediction
+TN, FP, FN, TP = range(4)
+
+def get_cells(predictions, references):
+    # one-hot confusion cell of every sample
+    cells = np.zeros((len(predictions), 4), dtype=np.int64)
+    cells[np.arange(len(predictions)), 2 * references + predictions] = 1
+    return cells
+
+def get_confusions(predictions, references, membership=None):
+    """Confusion counts (tn, fp, fn, tp) of all samples, or of every column of a (samples, columns) membership matrix of counts."""
+    cells = get_cells(predictions, references)
+
+    if membership is None:
+        return cells.sum(axis=0)
+
+    return membership.T @ cells
+
+def divide(numerator, denominator):
+    # sklearn scores a zero division as 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator > 0, numerator / np.where(denominator > 0, denominator, 1), 0.0)
+
+def macro_f1(confusions):
+    """Macro-F1 over the labels present in the references or predictions, as f1_score(average="macro")."""
+    tn, fp, fn, tp = np.moveaxis(confusions, -1, 0)
+    f1 = np.stack([divide(2 * tn, 2 * tn + fn + fp), divide(2 * tp, 2 * tp + fn + fp)], axis=-1)
+    present = np.stack([tn + fp + fn > 0, tp + fp + fn > 0], axis=-1)
+    return divide(np.where(present, f1, 0).sum(axis=-1), present.sum(axis=-1))
+
+def accuracy(confusions):
+    return divide(confusions[..., TN] + confusions[..., TP], confusions.sum(axis=-1))
+
+def precision(confusions):
+    return divide(confusions[..., TP], confusions[..., TP] + confusions[..., FP])
+
+def recall(confusions):
+    return divide(confusions[..., TP], confusions[..., TP] + confusions[..., FN])
+
+def exact_match(predictions, references, groups, num_groups=None):
+    """Share of groups whose samples are all correct, with groups given as integer ids."""
+    num_errors = np.bincount(groups, weights=predictions != references, minlength=num_groups or 0)
+    return np.mean(num_errors == 0)
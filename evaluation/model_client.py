@@ -0,0 +1,88 @@
+import json
+import time
+import itertools
+import urllib.request
+import urllib.error
+
+class ModelClient():
+    """Stands in for ModelWrapper by sending the scoring requests to a model_server.py process."""
+
+    def __init__(self, url, timeout=None):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.info = self.request("GET", "/health")
+        self.model_name = self.info["model"]
+        self.precision = self.info["precision"]
+        self.load_time = self.info["load_time"]
+        self.draft_model_name = self.info["draft_model"]
+
+    def request(self, method, path, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers={"Content-Type": "application/json"})
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise ValueError(f"Model server {self.url} failed on {path}: {e.read().decode('utf-8')}")
+
+    def get_model_name(self):
+        return self.model_name
+
+    def get_prompt_lengths(self, prompts):
+        return self.request("POST", "/lengths", {"prompts": prompts})["lengths"]
+
+    def set_shared_prefix(self, prompts, input_ids=None):
+        return self.request("POST", "/prefix", {"prompts": prompts, "input_ids": input_ids})["shared_prefix_tokens"]
+
+    def calibrate(self, content_free_prompts):
+        return self.request("POST", "/calibrate", {"prompts": content_free_prompts})["biases"]
+
+    def set_letters_biases(self, biases):
+        self.request("POST", "/biases", {"biases": biases})
+
+    def score_answers(self, prompts, input_ids=None):
+        return self.request("POST", "/score", {"prompts": prompts, "input_ids": input_ids})["answers"]
+
+    def score_options(self, prompt, options, context_ids=None):
+        return self.request("POST", "/options", {"prompt": prompt, "options": options, "context_ids": context_ids})["option_scores"]
+
+    def generate_answers(self, prompts, max_tokens=1, temperature=0.5, top_k=20, top_p=0.95, do_sample=True, input_ids=None):
+        payload = {"prompts": prompts, "max_tokens": max_tokens, "temperature": temperature, "top_k": top_k, "top_p": top_p, "do_sample": do_sample, "input_ids": input_ids}
+        return self.request("POST", "/generate", payload)["answers"]
+
+    def generate_stream(self, requests, batch_size, **generate_kwargs):
+        # the server answers whole requests, so prompts are sent in static batches
+        return self.generate_static_stream(requests, batch_size, **generate_kwargs)
+
+    def generate_static_stream(self, requests, batch_size, **generate_kwargs):
+        requests = iter(requests)
+
+        for batch in iter(lambda: list(itertools.islice(requests, batch_size)), []):
+            keys, prompts, all_input_ids = zip(*batch)
+            input_ids = None if any(ids is None for ids in all_input_ids) else list(all_input_ids)
+            yield from zip(keys, self.generate_answers(list(prompts), input_ids=input_ids, **generate_kwargs))
+
+    def get_generation_stats(self):
+        return self.request("GET", "/stats")
+
+    def reset_generation_stats(self):
+        self.request("POST", "/stats/reset", {})
+
+    def shutdown(self):
+        self.request("POST", "/shutdown", {})
+
+def wait_for_server(url, process=None, timeout=3600, interval=5):
+    """Polls the health endpoint until the server has loaded its model, failing early if its process exits."""
+    start = time.time()
+
+    while time.time() - start < timeout:
+        if process is not None and process.poll() is not None:
+            raise ValueError(f"Model server exited with code {process.returncode} before becoming ready.")
+
+        try:
+            return ModelClient(url)
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(interval)
+
+    raise ValueError(f"Model server {url} not ready after {timeout} seconds.")
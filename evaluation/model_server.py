@@ -0,0 +1,87 @@
+import argparse
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from evaluate_hf import ModelWrapper, PRECISIONS, MODELS_MAP
+from weights_cache import WEIGHTS_CACHE_DIR
+
+class ModelRequestHandler(BaseHTTPRequestHandler):
+    """Serves the ModelWrapper of the server as JSON over HTTP, one request at a time."""
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json({"model": self.server.model.get_model_name(), "precision": self.server.model.precision, "load_time": self.server.model.load_time, "draft_model": self.server.model.draft_model_name})
+        elif self.path == "/stats":
+            self.send_json(self.server.model.get_generation_stats())
+        else:
+            self.send_json({"error": f"Unknown path {self.path}"}, status=404)
+
+    def do_POST(self):
+        model = self.server.model
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+
+        try:
+            if self.path == "/score":
+                self.send_json({"answers": model.score_answers(payload["prompts"], payload.get("input_ids"))})
+            elif self.path == "/options":
+                self.send_json({"option_scores": model.score_options(payload["prompt"], payload["options"], payload.get("context_ids"))})
+            elif self.path == "/calibrate":
+                self.send_json({"biases": model.calibrate(payload["prompts"])})
+            elif self.path == "/biases":
+                model.set_letters_biases(payload["biases"])
+                self.send_json({})
+            elif self.path == "/generate":
+                prompts = payload.pop("prompts")
+                self.send_json({"answers": model.generate_answers(prompts, **payload)})
+            elif self.path == "/stats/reset":
+                model.reset_generation_stats()
+                self.send_json({})
+            elif self.path == "/lengths":
+                self.send_json({"lengths": model.get_prompt_lengths(payload["prompts"])})
+            elif self.path == "/prefix":
+                self.send_json({"shared_prefix_tokens": model.set_shared_prefix(payload["prompts"], payload.get("input_ids"))})
+            elif self.path == "/shutdown":
+                self.send_json({})
+                # shutdown waits for serve_forever to return, so it cannot run on the serving thread
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                self.send_json({"error": f"Unknown path {self.path}"}, status=404)
+        except Exception as e:
+            self.send_json({"error": repr(e)}, status=500)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, help="Model to serve", default="gpt2")
+    parser.add_argument("--precision", type=str, choices=PRECISIONS, default="fp32", help="Weights precision on CPU")
+    parser.add_argument("--weights-cache-dir", type=str, default=WEIGHTS_CACHE_DIR, help="Directory of the safetensors conversions of local .bin checkpoints")
+    parser.add_argument("--draft-model", type=str, choices=list(MODELS_MAP), default=None, help="Small model sharing the tokenizer of --model for assisted generation")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+
+    args = parser.parse_args()
+
+    # the port only opens once the model is loaded, so clients can poll the health endpoint until then
+    model = ModelWrapper(args.model, precision=args.precision, weights_cache_dir=args.weights_cache_dir, draft_model_name=args.draft_model)
+    server = HTTPServer((args.host, args.port), ModelRequestHandler)
+    server.model = model
+    print(f"Serving {args.model} on http://{args.host}:{args.port}")
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
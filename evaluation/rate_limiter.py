@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+class TokenBucket():
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.level = capacity
+        self.last_refill = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    def wait_time(self, amount):
+        # a single request larger than the bucket can never fit, so it only waits for a full bucket
+        amount = min(amount, self.capacity)
+        self.refill()
+
+        if self.level >= amount:
+            return 0
+
+        return (amount - self.level) / self.refill_rate
+
+    def consume(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+class RateLimiter():
+    """Budgets both requests per minute and tokens per minute for a single model."""
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm, rpm / 60)
+        self.tokens = TokenBucket(tpm, tpm / 60)
+        self.lock = None
+
+    async def acquire(self, num_tokens):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        # waiters queue up on the lock so requests are admitted in arrival order
+        async with self.lock:
+            while True:
+                wait_time = max(self.requests.wait_time(1), self.tokens.wait_time(num_tokens))
+
+                if wait_time <= 0:
+                    break
+
+                await asyncio.sleep(wait_time)
+
+            self.requests.consume(1)
+            self.tokens.consume(num_tokens)
+
+    def reconcile(self, estimated_tokens, used_tokens):
+        # the estimate reserves the full max_tokens completion, return what was not used
+        if used_tokens < estimated_tokens:
+            self.tokens.give_back(estimated_tokens - used_tokens)
+        else:
+            self.tokens.consume(used_tokens - estimated_tokens)
@@ -7,9 +7,20 @@ from collections import defaultdict
 sys.path.append("../")
 
 from utils import read_json, write_json, find_json_files, get_avg_metrics_from_dicts
+from bootstrap import aggregate_intervals
 
 TASKS = ["dialogue", "summarization", "intent", "safety", "stance", "mt_en_fr", "mt_en_de", "mt_en_ru", "mt_zh_en"]
 
+def average_with_intervals(lst_of_dicts):
+    avg_metrics = get_avg_metrics_from_dicts(lst_of_dicts)
+
+    # runs share their data, so their mean is as uncertain as a single run and keeps the average standard error
+    if all("ci" in metrics for metrics in lst_of_dicts):
+        cis = [metrics["ci"] for metrics in lst_of_dicts]
+        avg_metrics["ci"] = {"confidence": cis[0]["confidence"], "method": "normal", **aggregate_intervals(cis, avg_metrics, cis[0]["confidence"], independent=False)}
+
+    return avg_metrics
+
 def compute_avg_metrics(model, results_dirs):
     task_metrics_lst_map = defaultdict(list)
     agg_metrics_lst = []
@@ -36,9 +47,9 @@ def compute_avg_metrics(model, results_dirs):
 
     for task, task_metrics_lst in task_metrics_lst_map.items():
         if task_metrics_lst:
-            avg_metrics_per_task[task] = get_avg_metrics_from_dicts(task_metrics_lst)
+            avg_metrics_per_task[task] = average_with_intervals(task_metrics_lst)
         
-    global_avg_metrics = get_avg_metrics_from_dicts(agg_metrics_lst)
+    global_avg_metrics = average_with_intervals(agg_metrics_lst)
 
     return global_avg_metrics, avg_metrics_per_task
             
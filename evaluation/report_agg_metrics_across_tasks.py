@@ -6,7 +6,8 @@ from collections import defaultdict
 
 sys.path.append("../")
 
-from utils import read_json, write_json, find_json_files
+from utils import read_json, write_json, find_json_files, NON_METRIC_KEYS
+from bootstrap import aggregate_intervals
 
 TASKS = ["dialogue", "summarization", "intent", "safety", "stance", "mt_en_fr", "mt_en_de", "mt_en_ru", "mt_zh_en"]
 MT_TASKS = ["mt_en_fr", "mt_en_de", "mt_en_ru", "mt_zh_en"]
@@ -18,6 +19,8 @@ def compute_agg_metrics(model, results_dir):
     agg_cost_metrics = defaultdict(list)
     non_mt_agg_metrics = defaultdict(list)
     non_mt_agg_dim_metrics = defaultdict(list)
+    task_cis = []
+    non_mt_task_cis = []
 
     files = find_json_files(results_dir)
 
@@ -32,8 +35,17 @@ def compute_agg_metrics(model, results_dir):
 
                 if task not in seen_tasks:
                     seen_tasks.add(task)
+
+                    if "ci" in metrics:
+                        task_cis.append(metrics["ci"])
+
+                        if task not in MT_TASKS:
+                            non_mt_task_cis.append(metrics["ci"])
+
                     for metric, value in metrics.items():
-                        if metric == "dimensions":
+                        if metric in NON_METRIC_KEYS:
+                            continue
+                        elif metric == "dimensions":
                             for dim, dim_value in value.items():
                                 agg_dim_metrics[dim].append(dim_value)
                         elif metric == "usage":
@@ -74,6 +86,17 @@ def compute_agg_metrics(model, results_dir):
     for dim, values in non_mt_agg_dim_metrics.items():
         metrics["non_mt_dimensions"][dim] = sum(values) / len(values)
 
+    # tasks are evaluated on different data, so the intervals of their mean come from their independent standard errors
+    if task_cis and len(task_cis) == len(seen_tasks):
+        confidence = task_cis[0]["confidence"]
+        metrics["ci"] = {"confidence": confidence, "method": "normal", **aggregate_intervals(task_cis, {**{metric: metrics[metric] for metric in agg_metrics}, "dimensions": metrics["dimensions"]}, confidence)}
+
+        if non_mt_task_cis:
+            non_mt_metrics = {**{metric: metrics[f"non_mt_{metric}"] for metric in non_mt_agg_metrics}, "dimensions": metrics["non_mt_dimensions"]}
+
+            for metric, interval in aggregate_intervals(non_mt_task_cis, non_mt_metrics, confidence).items():
+                metrics["ci"][f"non_mt_{metric}"] = interval
+
     return metrics
 
 def main():
@@ -1,6 +1,11 @@
 import argparse
 import sys
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
+import os
+import hashlib
+import functools
+import multiprocessing
+import numpy as np
+import ijson
 import pprint
 from collections import defaultdict
 import re
@@ -10,6 +15,8 @@ import pathlib
 sys.path.append("../")
 
 from utils import read_json, write_json, CK_DIMENSIONS, find_json_files, MODEL_COSTS, MODEL_ENCODINGS, num_tokens_from_string
+from metrics_engine import get_confusions, macro_f1, accuracy, precision, recall, exact_match
+from bootstrap import bootstrap_metrics
 
 TASK_TARGET_MAP = {
     "dialogue": "final_turn", 
@@ -71,10 +78,16 @@ def compute_usage(sample, model):
         "total": input_cost + output_cost
     }
 
-def compute_metrics(results, task):
-    metrics = {}
+def get_metric_arrays(samples, task, model=None):
+    """Integer arrays of the predictions, references, exact-match groups and knowledge dimensions of the answered samples, with their usage and cost."""
     predictions = []
     references = []
+    groups = []
+    group_indices = {}
+    dimension_indices = {dim: index for index, dim in enumerate(CK_DIMENSIONS)}
+    membership_rows = []
+    membership_cols = []
+    data_id_attr = "subdata_id" if task == "dialogue" else "data_id"
 
     usage = {
         "prompt_tokens": 0,
@@ -87,32 +100,24 @@ def compute_metrics(results, task):
         "output": 0,
         "total": 0
     }
-    
-    pred_ref_map = {}
-    dimension_pred_ref_map = {dim: {"predictions": [], "references": []} for dim in CK_DIMENSIONS}
-    data_id_attr = "subdata_id" if task == "dialogue" else "data_id"
-
-    for result in results["data"]:
-        response_attr = "response" if "response" in result else "generated_output"
 
-        if response_attr in result:
-            ref = 1 if result["answer"].lower() == "yes" else 0
-            pred = get_prediction(result[response_attr], result["type"])
-            references.append(ref)
-            predictions.append(pred)
-            pred_ref_item = pred_ref_map.get(result[data_id_attr], True)
-
-            pred_ref_map[result[data_id_attr]] = pred_ref_item & (pred == ref)
+    # samples are consumed one by one, so streamed results files are never held in memory
+    for result in samples:
+        # scoring-only runs of evaluate_hf keep just the yes/no decision of the logits
+        response_attr = next((attr for attr in ["response", "generated_output", "highest_proba"] if attr in result), None)
 
+        if response_attr is not None:
+            # a sample counts once for every knowledge item of a dimension
             target = result[TASK_TARGET_MAP[task]]
 
-            if "knowledge" in target:
-                for kg in target["knowledge"]:
-                    dimension = kg["dimension"]
-                    dimension_pred_ref_map[dimension]["predictions"].append(pred)
-                    dimension_pred_ref_map[dimension]["references"].append(ref)
-            
-            sample_usage, sample_cost = compute_usage(result, results["metadata"]["model"])
+            for kg in (target["knowledge"] if "knowledge" in target else []):
+                membership_rows.append(len(predictions))
+                membership_cols.append(dimension_indices[kg["dimension"]])
+
+            references.append(1 if result["answer"].lower() == "yes" else 0)
+            predictions.append(get_prediction(result[response_attr], "bcq" if response_attr == "highest_proba" else result["type"]))
+            groups.append(group_indices.setdefault(result[data_id_attr], len(group_indices)))
+            sample_usage, sample_cost = compute_usage(result, model)
 
             if sample_usage:
                 usage["prompt_tokens"] += sample_usage["prompt_tokens"]
@@ -123,39 +128,122 @@ def compute_metrics(results, task):
                 cost["input"] += sample_cost["input"]
                 cost["output"] += sample_cost["output"]
                 cost["total"] += sample_cost["total"]
-    
-    metrics["exact_match"] = sum(pred_ref_map.values()) / len(pred_ref_map)
-    metrics["macro_f1"] = f1_score(references, predictions, average='macro')
-    metrics["accuracy"] = accuracy_score(references, predictions)
-    metrics["precision"] = precision_score(references, predictions)
-    metrics["recall"] = recall_score(references, predictions)
-    metrics["dimensions"] = {}
-
-    for dim, pred_ref in dimension_pred_ref_map.items():
-        if pred_ref["references"]:
-            metrics["dimensions"][dim] = f1_score(pred_ref["references"], pred_ref["predictions"], average="macro")
-
-    metrics["usage"] = usage
-    metrics["cost"] = cost
-
-    return metrics
-
-def report_metrics(results_files):
-    for results_file in tqdm(results_files, total=len(results_files)):
-        results = read_json(results_file)
-        
-        try:
-            if "data" in results:
-                task = [task for task in TASKS if task in results_file][0]
-                metrics = compute_metrics(results, task)
-                write_json(metrics, results_file.replace(".json", "_metrics.json"))
-        except Exception as e:
-            print(results_file)
-            raise e
+
+    membership = np.zeros((len(predictions), len(dimension_indices)), dtype=np.int64)
+    np.add.at(membership, (np.array(membership_rows, dtype=np.int64), np.array(membership_cols, dtype=np.int64)), 1)
+
+    return {
+        "predictions": np.array(predictions, dtype=np.int64),
+        "references": np.array(references, dtype=np.int64),
+        "groups": np.array(groups, dtype=np.int64),
+        "membership": membership,
+        "usage": usage,
+        "cost": cost
+    }
+
+def compute_metrics_from_arrays(arrays):
+    predictions, references = arrays["predictions"], arrays["references"]
+    confusions = get_confusions(predictions, references)
+    # one confusion matrix per dimension, from the counts of knowledge items of every sample
+    dimension_confusions = get_confusions(predictions, references, arrays["membership"])
+
+    return {
+        "exact_match": float(exact_match(predictions, references, arrays["groups"])),
+        "macro_f1": float(macro_f1(confusions)),
+        "accuracy": float(accuracy(confusions)),
+        "precision": float(precision(confusions)),
+        "recall": float(recall(confusions)),
+        "dimensions": {dim: float(f1) for dim, f1, count in zip(CK_DIMENSIONS, macro_f1(dimension_confusions), dimension_confusions.sum(axis=-1)) if count > 0},
+        "usage": arrays["usage"],
+        "cost": arrays["cost"]
+    }
+
+def compute_metrics(results, task):
+    return compute_metrics_from_arrays(get_metric_arrays(results["data"], task, results["metadata"]["model"]))
+
+def hash_results_file(path, chunk_size=1024 ** 2):
+    sha = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def read_metadata(path):
+    # results files start with their metadata, so parsing stops long before the data
+    with open(path, "rb") as f:
+        return next(ijson.items(f, "metadata"), None)
+
+def stream_samples(path):
+    with open(path, "rb") as f:
+        yield from ijson.items(f, "data.item", use_float=True)
+
+def get_metrics_path(results_file):
+    return results_file.replace(".json", "_metrics.json")
+
+def is_up_to_date(metrics, content_hash, num_resamples, confidence, seed):
+    """Whether metrics were computed from the same content with the requested confidence intervals, or none when they are off."""
+    if metrics.get("content_hash") != content_hash:
+        return False
+
+    if num_resamples <= 0:
+        return "ci" not in metrics
+
+    ci = metrics.get("ci", {})
+    return ci.get("num_resamples") == num_resamples and ci.get("confidence") == confidence and ci.get("seed") == seed
+
+def report_file_metrics(results_file, force=False, num_resamples=10000, confidence=0.95, seed=0):
+    """Writes the metrics of a results file unless its _metrics.json was computed from the same content, returning whether it did."""
+    metrics_path = get_metrics_path(results_file)
+
+    try:
+        metadata = read_metadata(results_file)
+
+        if metadata is None or "model" not in metadata:
+            return False
+
+        content_hash = hash_results_file(results_file)
+
+        if not force and os.path.exists(metrics_path) and is_up_to_date(read_json(metrics_path), content_hash, num_resamples, confidence, seed):
+            return False
+
+        task = [task for task in TASKS if task in results_file][0]
+        arrays = get_metric_arrays(stream_samples(results_file), task, metadata["model"])
+
+        if len(arrays["predictions"]) == 0:
+            return False
+
+        metrics = compute_metrics_from_arrays(arrays)
+
+        if num_resamples > 0:
+            # data_id groups are resampled whole, since exact match is scored per group
+            metrics["ci"] = bootstrap_metrics(arrays, list(CK_DIMENSIONS), num_resamples=num_resamples, confidence=confidence, seed=seed)
+
+        metrics["content_hash"] = content_hash
+        write_json(metrics, metrics_path)
+        return True
+    except Exception as e:
+        print(results_file)
+        raise e
+
+def report_metrics(results_files, num_workers=1, force=False, num_resamples=10000, confidence=0.95, seed=0):
+    # metrics files are outputs of this script, not results
+    results_files = [results_file for results_file in results_files if not results_file.endswith("_metrics.json")]
+
+    with multiprocessing.Pool(num_workers) as pool:
+        num_written = sum(tqdm(pool.imap_unordered(functools.partial(report_file_metrics, force=force, num_resamples=num_resamples, confidence=confidence, seed=seed), results_files), total=len(results_files)))
+
+    print(f"Wrote metrics of {num_written} results files, {len(results_files) - num_written} were unchanged or not results")
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--results-path", type=str, help="Path to evaluation results file in json or directory", required=True)
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count(), help="Number of processes scoring results files")
+    parser.add_argument("--force", action="store_true", default=False, help="Recompute the metrics of results files whose content has not changed")
+    parser.add_argument("--num-resamples", type=int, default=10000, help="Number of bootstrap resamples of the confidence intervals (0 to skip them)")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of the bootstrap intervals")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the bootstrap resamples")
 
     args = parser.parse_args()
 
@@ -168,7 +256,7 @@ def main():
     else:
         files_to_process.extend(find_json_files(args.results_path))
 
-    report_metrics(files_to_process)
+    report_metrics(files_to_process, num_workers=args.num_workers, force=args.force, num_resamples=args.num_resamples, confidence=args.confidence, seed=args.seed)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+def get_cache_key(backend, model, prompt, params):
+    payload = json.dumps({"backend": backend, "model": model, "prompt": prompt, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache():
+    """On-disk cache of model responses keyed by a hash of (backend, model, prompt, generation params).
+
+    Entries are namespaced per backend and model, and the least recently used entries are evicted
+    once the total size of the stored responses exceeds max_size bytes.
+    """
+
+    def __init__(self, path, max_size=2 * 1024 ** 3):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (namespace TEXT, key TEXT, value TEXT, size INTEGER, last_access REAL, PRIMARY KEY (namespace, key))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, backend, model, prompt, params):
+        namespace = f"{backend}/{model}"
+        key = get_cache_key(backend, model, prompt, params)
+        row = self.conn.execute("SELECT value FROM responses WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.conn.execute("UPDATE responses SET last_access = ? WHERE namespace = ? AND key = ?", (time.time(), namespace, key))
+        self.conn.commit()
+
+        return json.loads(row[0])
+
+    def put(self, backend, model, prompt, params, value):
+        namespace = f"{backend}/{model}"
+        key = get_cache_key(backend, model, prompt, params)
+        value = json.dumps(value)
+        size = len(value.encode("utf-8"))
+
+        row = self.conn.execute("SELECT size FROM responses WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+
+        if row is not None:
+            self.size -= row[0]
+
+        self.conn.execute("INSERT OR REPLACE INTO responses (namespace, key, value, size, last_access) VALUES (?, ?, ?, ?, ?)", (namespace, key, value, size, time.time()))
+        self.size += size
+        self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        while self.size > self.max_size:
+            rows = self.conn.execute("SELECT namespace, key, size FROM responses ORDER BY last_access LIMIT 100").fetchall()
+
+            if not rows:
+                break
+
+            for namespace, key, size in rows:
+                if self.size <= self.max_size:
+                    break
+
+                self.conn.execute("DELETE FROM responses WHERE namespace = ? AND key = ?", (namespace, key))
+                self.size -= size
+                self.evictions += 1
+
+    def clear(self, backend, model):
+        namespace = f"{backend}/{model}"
+        self.conn.execute("DELETE FROM responses WHERE namespace = ?", (namespace,))
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": self.size,
+            "max_size": self.max_size
+        }
+
+    def close(self):
+        self.conn.close()
@@ -1,11 +1,15 @@
 import argparse
 import sys
+import os
+import functools
+import multiprocessing
+from collections import defaultdict
 import pprint
 import pandas as pd
+import numpy as np
 import scipy.stats as stats
-import random
-from tqdm import tqdm
 import pathlib
+from tqdm import tqdm
 
 sys.path.append("../")
 
@@ -70,28 +74,32 @@ TASK_MAP = {
     }
 }
 
-def computer_mcnemar(df, sig_level=0.01):
+def computer_mcnemar(df, sig_level=0.01, verbose=True):
     # create contingency table
     data_crosstab = pd.crosstab(df['model'],
                                 df['human'],
-                                margins=True, margins_name="Total")
-    pprint.pprint(data_crosstab)
+                                margins=True, margins_name="Total", dropna=False)
+    if verbose:
+        pprint.pprint(data_crosstab)
 
     # Calcualtion of McNemar's statistic
     rows = df['model'].unique()
     columns = df['human'].unique()
-    mcnemar = (abs(data_crosstab['correct']['incorrect'] - data_crosstab['incorrect']['correct']) - 1)**2 / (data_crosstab['correct']['incorrect'] + data_crosstab['incorrect']['correct'])
+    discordant = data_crosstab['correct']['incorrect'] + data_crosstab['incorrect']['correct']
+    mcnemar = (abs(data_crosstab['correct']['incorrect'] - data_crosstab['incorrect']['correct']) - 1)**2 / discordant if discordant else 0.0
 
 
     # The p-value approach
-    print("Approach 1: The p-value approach to hypothesis testing in the decision rule")
-    p_value = 1 - stats.chi2.cdf(mcnemar, (len(rows)-1)*(len(columns)-1))
+    if verbose:
+        print("Approach 1: The p-value approach to hypothesis testing in the decision rule")
+    p_value = 1 - stats.chi2.cdf(mcnemar, max((len(rows)-1)*(len(columns)-1), 1)) if discordant else 1.0
     conclusion = "Failed to reject the null hypothesis."
     if p_value <= sig_level:
         conclusion = "Null Hypothesis is rejected."
             
-    print("McNemar's statistic is:", mcnemar, " and p value is:", p_value)
-    print(conclusion)
+    if verbose:
+        print("McNemar's statistic is:", mcnemar, " and p value is:", p_value)
+        print(conclusion)
         
     # # The critical value approach
     # print("\n--------------------------------------------------------------------------------------")
@@ -104,16 +112,17 @@ def computer_mcnemar(df, sig_level=0.01):
     # print("McNemar's statistic is:", mcnemar, " and critical value is:", critical_value)
     # print(conclusion)
     return {
-        "statistic": mcnemar,
-        "p_value": p_value,
+        "statistic": float(mcnemar),
+        "p_value": float(p_value),
         "conclusion": conclusion,
     }
 
-def compute_fisher_exact(df, sig_level=0.01):
+def compute_fisher_exact(df, sig_level=0.01, verbose=True):
     # create contingency table
     data_crosstab = pd.crosstab(df['model'],
-                                df['human'])
-    pprint.pprint(data_crosstab)
+                                df['human'], dropna=False)
+    if verbose:
+        pprint.pprint(data_crosstab)
 
     res = stats.fisher_exact(data_crosstab.to_numpy())
     p_value = res.pvalue
@@ -122,25 +131,27 @@ def compute_fisher_exact(df, sig_level=0.01):
     if p_value <= sig_level:
         conclusion = "Null Hypothesis is rejected."
             
-    print("Fisher's exact statistic is:", res.statistic, " and p value is:", p_value)
-    print(conclusion)
+    if verbose:
+        print("Fisher's exact statistic is:", res.statistic, " and p value is:", p_value)
+        print(conclusion)
 
     return {
-        "statistic": res.statistic,
-        "p_value": p_value,
+        "statistic": float(res.statistic),
+        "p_value": float(p_value),
         "conclusion": conclusion,
     }
 
-def compute_binomial_test(df, sig_level=0.01):
+def compute_binomial_test(df, sig_level=0.01, verbose=True):
     # create contingency table
     data_crosstab = pd.crosstab(df['model'],
-                                df['human'], margins=True, margins_name="Total")
-    pprint.pprint(data_crosstab)
-    human_k = data_crosstab.loc["Total", "correct"]
-    model_k = data_crosstab.loc["correct", "Total"]
-    n = data_crosstab.loc["Total", "Total"]
+                                df['human'], margins=True, margins_name="Total", dropna=False)
+    human_k = int(data_crosstab.loc["Total", "correct"])
+    model_k = int(data_crosstab.loc["correct", "Total"])
+    n = int(data_crosstab.loc["Total", "Total"])
     p = model_k / n
-    print("Human k:", human_k, "Model k:", model_k, "n:", n, "p:", p)
+    if verbose:
+        pprint.pprint(data_crosstab)
+        print("Human k:", human_k, "Model k:", model_k, "n:", n, "p:", p)
     res = stats.binomtest(k=human_k, n=n, p=p, alternative="greater")
     p_value = res.pvalue
     conclusion = "Failed to reject the null hypothesis."
@@ -148,138 +159,413 @@ def compute_binomial_test(df, sig_level=0.01):
     if p_value <= sig_level:
         conclusion = "Null Hypothesis is rejected."
             
-    print("Binomial exact statistic is:", res.statistic, " and p value is:", p_value)
-    print(conclusion)
+    if verbose:
+        print("Binomial exact statistic is:", res.statistic, " and p value is:", p_value)
+        print(conclusion)
 
     return {
-        "statistic": res.statistic,
-        "p_value": p_value,
+        "statistic": float(res.statistic),
+        "p_value": float(p_value),
         "conclusion": conclusion,
     }
 
-def compute_pitman(df, sig_level=0.01, sample_size=10000):
-    model_wins = 0
-    human_wins = 0
+def compute_pitman(df, sig_level=0.01, sample_size=10000, seed=None, chunk_size=1000, verbose=True):
+    model = (df["model"] == "correct").to_numpy()
+    human = (df["human"] == "correct").to_numpy()
+    n = len(df)
 
-    for i in tqdm(range(sample_size)):
-        model_preds = []
-        human_preds = []
+    # swapping the two answers of a pair only changes the accuracies when exactly one of them is correct,
+    # so the permutation distribution of the accuracy difference is that of +-1 signs over the discordant pairs
+    differences = human.astype(np.int64) - model.astype(np.int64)
+    discordant = differences[differences != 0]
+    observed = differences.sum()
 
-        for _, row in df.iterrows():
-            coin = random.random()
+    rng = np.random.default_rng(seed)
+    model_wins = 0
+    human_wins = 0
+    as_extreme = 0
+
+    for start in range(0, sample_size, chunk_size):
+        size = min(chunk_size, sample_size - start)
+        # a chunk of the (sample_size x pairs) swap matrix bounds memory to chunk_size rows
+        swaps = rng.integers(0, 2, size=(size, len(discordant)), dtype=np.int8) * 2 - 1
+        permuted = swaps @ discordant
+
+        human_wins += int((permuted > 0).sum())
+        model_wins += int((permuted < 0).sum())
+        as_extreme += int((permuted >= observed).sum())
+
+    # the number of discordant pairs the human gets right is Binomial(m, 0.5) under the null hypothesis,
+    # which gives the exact p-value of the permutation distribution
+    human_only = int((differences > 0).sum())
+    p_value = stats.binomtest(k=human_only, n=len(discordant), p=0.5, alternative="greater").pvalue if len(discordant) else 1.0
+    p_value = float(p_value)
+    monte_carlo_p_value = (as_extreme + 1) / (sample_size + 1)
+    statistic = float(observed / n) if n else 0.0
 
-            if coin > 0.5:
-                model_preds.append(1 if row["human"] == "correct" else 0)
-                human_preds.append(1 if row["model"] == "correct" else 0)
-            else:
-                model_preds.append(1 if row["model"] == "correct" else 0)
-                human_preds.append(1 if row["human"] == "correct" else 0)
-        
-        model_accuracy = sum(model_preds) / len(model_preds)
-        human_accuracy = sum(human_preds) / len(human_preds)
-
-        if model_accuracy > human_accuracy:
-            model_wins += 1
-        elif human_accuracy > model_accuracy:
-            human_wins += 1
-        else:
-            pass
-    
-    statistic = (human_wins - model_wins) / sample_size
-    print("Model wins:", model_wins / sample_size, "Human wins:", human_wins / sample_size)
-    print("Pitman's test statistic is:", statistic)
     conclusion = "Failed to reject the null hypothesis."
 
-    if statistic > 0:
+    if p_value <= sig_level:
         conclusion = "Null Hypothesis is rejected."
 
+    if verbose:
+        print("Model wins:", model_wins / sample_size, "Human wins:", human_wins / sample_size)
+        print("Pitman's test statistic is:", statistic, " and p value is:", p_value, "(Monte Carlo:", monte_carlo_p_value, ")")
+        print(conclusion)
+
     return {
         "times": sample_size,
+        "seed": seed,
+        "discordant_pairs": len(discordant),
         "model_wins": model_wins / sample_size,
         "human_wins": human_wins / sample_size,
         "statistic": statistic,
         "conclusion": conclusion,
-        "p_value": None,
+        "p_value": p_value,
+        "monte_carlo_p_value": monte_carlo_p_value,
+    }
+
+TESTS = {
+    "mcnemar": computer_mcnemar,
+    "fisher": compute_fisher_exact,
+    "binomial": compute_binomial_test,
+    "pitman": compute_pitman,
+}
+
+CORRECTIONS = ["holm", "bonferroni", "fdr_bh", "none"]
+
+HUMAN = "human"
+
+def get_correct_key(metadata):
+    # evaluate_hf keeps the correctness of each answering method, evaluate_gpt and the baselines a single one
+    if "generate" in metadata:
+        return "correct_generated_output" if metadata["generate"] else "correct_highest_proba"
+
+    return "correct"
+
+def read_model_results(results_file):
+    """Metadata and samples of a results file with the correctness of every sample under "correct", or None if it has none."""
+    results = read_json(results_file)
+
+    if not isinstance(results, dict) or "metadata" not in results or "data" not in results:
+        return None
+
+    correct_key = get_correct_key(results["metadata"])
+
+    # mcq results are scored per option, so their samples have no correctness to compare
+    if any(correct_key not in sample for sample in results["data"]):
+        print(f"Results {results_file} have no {correct_key} for every sample. Skipping them.")
+        return None
+
+    for sample in results["data"]:
+        sample["correct"] = sample[correct_key]
+
+    return results
+
+def get_model_results_map(samples, task):
+    task_info = TASK_MAP[task]
+    return {result[task_info["model_id_attr"]]: result for result in samples}
+
+def match_human_result(human_result, model_results_map, task):
+    """Instance id of the model result a human annotation was given on, or None."""
+    task_info = TASK_MAP[task]
+    human_id = human_result[task_info["human_id_attr"]]
+
+    if task in ["mt_zh_en", "mt_en_de", "mt_en_fr", "mt_en_ru"]:
+        human_id = human_result[task_info["human_id_attr"]] + "-" + str(human_result["label"])
+
+    if human_id in model_results_map:
+        return human_id
+
+    if task == "intent":
+        for i in range(10):
+            human_id = f'{human_result["data_id"]}-intent-{i}'
+            if human_id in model_results_map:
+                model_result = model_results_map[human_id]
+                if human_result["label"] == model_result["intent"]["label"] and human_result["intent"] == model_result["intent"]["text"]:
+                    return human_id
+        return None
+
+    print("Human ID {} not found in model results".format(human_id))
+    return None
+
+def get_pairs_frame(first_correct, second_correct):
+    # categories keep both rows and columns in the contingency tables when a side is always right or wrong
+    categories = ["correct", "incorrect"]
+    return pd.DataFrame({
+        "model": pd.Categorical(np.where(first_correct, "correct", "incorrect"), categories=categories),
+        "human": pd.Categorical(np.where(second_correct, "correct", "incorrect"), categories=categories),
+    })
+
+def run_test(test, df, sig_level, sample_size=10000, seed=0, verbose=True):
+    if test not in TESTS:
+        raise ValueError("Unknown test type: {}".format(test))
+
+    if test == "pitman":
+        return compute_pitman(df, sig_level, sample_size=sample_size, seed=seed, verbose=verbose)
+
+    return TESTS[test](df, sig_level, verbose=verbose)
+
+def load_task_correctness(task, results_files, human_results_file):
+    """Correctness of every run and of the human annotations of a task, indexed by the instances of its runs."""
+    run_results_maps = {}
+
+    for run, results_file in results_files.items():
+        results = read_model_results(results_file)
+
+        if results is not None:
+            run_results_maps[run] = get_model_results_map(results["data"], task)
+
+    # runs can miss instances, so they are indexed by the union of their instance ids and a presence mask
+    all_results_map = {}
+    for model_results_map in run_results_maps.values():
+        for instance_id, result in model_results_map.items():
+            all_results_map.setdefault(instance_id, result)
+
+    instance_index = {instance_id: i for i, instance_id in enumerate(sorted(all_results_map))}
+    runs = {}
+
+    for run, model_results_map in run_results_maps.items():
+        rows = np.fromiter((instance_index[instance_id] for instance_id in model_results_map), dtype=np.int64, count=len(model_results_map))
+        present = np.zeros(len(instance_index), dtype=bool)
+        correct = np.zeros(len(instance_index), dtype=bool)
+        present[rows] = True
+        correct[rows] = [bool(result["correct"]) for result in model_results_map.values()]
+        runs[run] = {"present": present, "correct": correct}
+
+    # instances can have several human annotations, so humans are kept as (instance row, correct) pairs
+    human_rows = []
+    human_correct = []
+
+    if human_results_file is not None:
+        for human_result in read_json(human_results_file):
+            instance_id = match_human_result(human_result, all_results_map, task)
+
+            if instance_id is not None:
+                human_rows.append(instance_index[instance_id])
+                human_correct.append(bool(human_result["correct"]))
+
+    return runs, {"rows": np.array(human_rows, dtype=np.int64), "correct": np.array(human_correct, dtype=bool)}
+
+def get_run_names(results_files, outputs_dir):
+    """Names of results files of a task after their run directory under outputs_dir, and their file stem when the directory holds several."""
+    run_dirs = defaultdict(list)
+
+    for results_file in results_files:
+        run_dirs[str(pathlib.Path(results_file).parent.relative_to(outputs_dir))].append(results_file)
+
+    names = {}
+
+    for run_dir, dir_files in run_dirs.items():
+        # other templates or models in the same directory are distinct runs, not copies of one
+        for results_file in dir_files:
+            names[run_dir if len(dir_files) == 1 else f"{run_dir}/{pathlib.Path(results_file).stem}"] = results_file
+
+    return names
+
+def get_task_pairs(task, runs, human):
+    """Aligned correctness of every model x human and model x model pair of a task, the second side in the human column."""
+    names = sorted(runs)
+
+    for i, first in enumerate(names):
+        if len(human["rows"]):
+            present = runs[first]["present"][human["rows"]]
+            yield task, first, HUMAN, runs[first]["correct"][human["rows"]][present], human["correct"][present]
+
+        for second in names[i + 1:]:
+            present = runs[first]["present"] & runs[second]["present"]
+            yield task, first, second, runs[first]["correct"][present], runs[second]["correct"][present]
+
+def run_pair_tests(pair, tests, sig_level, sample_size=10000, seed=0, verbose=False):
+    task, first, second, first_correct, second_correct = pair
+    results = {}
+
+    if len(first_correct) > 0:
+        df = get_pairs_frame(first_correct, second_correct)
+        results = {test: run_test(test, df, sig_level, sample_size=sample_size, seed=seed, verbose=verbose) for test in tests}
+
+    return {
+        "task": task,
+        "first": first,
+        "second": second,
+        "n": int(len(first_correct)),
+        "first_accuracy": float(first_correct.mean()) if len(first_correct) else None,
+        "second_accuracy": float(second_correct.mean()) if len(second_correct) else None,
+        "results": results,
+    }
+
+def adjust_p_values(p_values, method):
+    """Multiple-comparison adjusted p-values, as statsmodels multipletests."""
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values)
+
+    if m == 0 or method == "none":
+        return p_values
+
+    if method == "bonferroni":
+        return np.minimum(p_values * m, 1.0)
+
+    order = np.argsort(p_values)
+    ranked = p_values[order]
+
+    if method == "holm":
+        adjusted = np.minimum(np.maximum.accumulate(ranked * (m - np.arange(m))), 1.0)
+    elif method == "fdr_bh":
+        adjusted = np.minimum.accumulate((ranked * m / np.arange(1, m + 1))[::-1])[::-1]
+        adjusted = np.minimum(adjusted, 1.0)
+    else:
+        raise ValueError(f"Unknown correction method: {method}")
+
+    result = np.empty(m)
+    result[order] = adjusted
+    return result
+
+def build_matrices(pair_results, tests, sig_level, correction):
+    """Per task and test, matrices of p-values over its participants, corrected over all pairs of the task."""
+    matrices = {}
+
+    for task in sorted({pair["task"] for pair in pair_results}):
+        task_pairs = [pair for pair in pair_results if pair["task"] == task and pair["results"]]
+        participants = sorted({pair["first"] for pair in task_pairs} | {pair["second"] for pair in task_pairs} - {HUMAN})
+
+        if any(pair["second"] == HUMAN for pair in task_pairs):
+            participants.append(HUMAN)
+
+        position = {participant: i for i, participant in enumerate(participants)}
+        size = len(participants)
+        n = [[None] * size for _ in range(size)]
+
+        for pair in task_pairs:
+            n[position[pair["first"]]][position[pair["second"]]] = pair["n"]
+
+        task_matrices = {"participants": participants, "n": n, "tests": {}}
+
+        for test in tests:
+            # each test of a task is one family of comparisons
+            adjusted = adjust_p_values([pair["results"][test]["p_value"] for pair in task_pairs], correction)
+            matrix = {key: [[None] * size for _ in range(size)] for key in ["statistic", "p_value", "adjusted_p_value", "rejected"]}
+
+            for pair, adjusted_p_value in zip(task_pairs, adjusted):
+                row, column = position[pair["first"]], position[pair["second"]]
+                matrix["statistic"][row][column] = pair["results"][test]["statistic"]
+                matrix["p_value"][row][column] = pair["results"][test]["p_value"]
+                matrix["adjusted_p_value"][row][column] = float(adjusted_p_value)
+                matrix["rejected"][row][column] = bool(adjusted_p_value <= sig_level)
+
+            task_matrices["tests"][test] = matrix
+
+        matrices[task] = task_matrices
+
+    return matrices
+
+def find_task_file(json_files, task):
+    task_files = [file for file in json_files if task in pathlib.Path(file).name and "metrics" not in file]
+    return task_files[0] if task_files else None
+
+def run_all_pairs(outputs_dir, human_results_path, tasks, tests, sig_level=0.05, correction="holm", num_workers=1, sample_size=10000, seed=0, verbose=False):
+    """Tests every model x human and model x model pair of every task, loading each results file once."""
+    outputs_dir = pathlib.Path(outputs_dir)
+    human_results_path = pathlib.Path(human_results_path)
+    human_files = find_json_files(human_results_path) if human_results_path.is_dir() else [str(human_results_path)]
+
+    task_files = defaultdict(list)
+    for json_file in sorted(find_json_files(outputs_dir)):
+        json_path = pathlib.Path(json_file)
+        task = next((task for task in tasks if task in json_path.name), None)
+
+        if task is None or "metrics" in json_path.name:
+            continue
+
+        task_files[task].append(json_file)
+
+    pairs = []
+    for task in tasks:
+        if task not in task_files:
+            print(f"No results of task {task} in {outputs_dir}. Skipping it.")
+            continue
+
+        runs, human = load_task_correctness(task, get_run_names(task_files[task], outputs_dir), find_task_file(human_files, task))
+        pairs.extend(get_task_pairs(task, runs, human))
+
+    run_tests = functools.partial(run_pair_tests, tests=tests, sig_level=sig_level, sample_size=sample_size, seed=seed, verbose=verbose)
+
+    with multiprocessing.Pool(num_workers) as pool:
+        pair_results = list(tqdm(pool.imap_unordered(run_tests, pairs, chunksize=8), total=len(pairs), desc="Testing pairs"))
+
+    pair_results.sort(key=lambda pair: (pair["task"], pair["first"], pair["second"]))
+
+    return {
+        "tests": tests,
+        "sig_level": sig_level,
+        "correction": correction,
+        "sample_size": sample_size,
+        "seed": seed,
+        "outputs_dir": str(outputs_dir),
+        "human_path": str(human_results_path),
+        "tasks": build_matrices(pair_results, tests, sig_level, correction),
+        "pairs": pair_results,
     }
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model-results", type=str, help="Path to evaluation model results", required=True)
-    parser.add_argument("--human-results", type=str, help="Path to evaluation human results", required=True)
-    parser.add_argument("--task", type=str, help="Task name", required=True)
+    parser.add_argument("--model-results", type=str, help="Path to evaluation model results")
+    parser.add_argument("--human-results", type=str, help="Path to evaluation human results, a directory of one file per task with --all-pairs", required=True)
+    parser.add_argument("--task", type=str, help="Task name")
     parser.add_argument("--test", type=str, help="Test name", default="binomial")
     parser.add_argument("--sig-level", type=float, help="Significance level", default=0.05)
     parser.add_argument("--output-dir", type=str, default="stats_test_outputs", help="Output directory")
+    parser.add_argument("--sample-size", type=int, default=10000, help="Number of random swaps of the Pitman permutation test")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the Pitman permutation test")
+    parser.add_argument("--all-pairs", action="store_true", default=False, help="Test every model x human and model x model pair of every run under --outputs-dir")
+    parser.add_argument("--outputs-dir", type=str, default="outputs", help="Directory of the runs to test with --all-pairs")
+    parser.add_argument("--tasks", type=str, nargs="+", default=list(TASK_MAP), choices=list(TASK_MAP), help="Tasks to test with --all-pairs")
+    parser.add_argument("--tests", type=str, nargs="+", default=list(TESTS), choices=list(TESTS), help="Tests to run with --all-pairs")
+    parser.add_argument("--correction", type=str, default="holm", choices=CORRECTIONS, help="Multiple-comparison correction of the --all-pairs p-values")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count(), help="Number of processes testing pairs with --all-pairs")
+    parser.add_argument("--verbose", action="store_true", default=False, help="Print the contingency table and result of every --all-pairs test")
     
     args = parser.parse_args()
 
+    if args.all_pairs:
+        outputs = run_all_pairs(args.outputs_dir, args.human_results, args.tasks, args.tests, sig_level=args.sig_level, correction=args.correction, num_workers=args.num_workers, sample_size=args.sample_size, seed=args.seed, verbose=args.verbose)
+        pathlib.Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+        output_path = pathlib.Path(args.output_dir) / f"stat_test_matrix_{args.correction}.json"
+        write_json(outputs, output_path)
+        print(f"Wrote {len(outputs['pairs'])} pairs of {len(outputs['tasks'])} tasks to {output_path}")
+        return
+
+    if args.model_results is None or args.task is None:
+        raise ValueError("--model-results and --task are required without --all-pairs.")
+
     model_results_path = pathlib.Path(args.model_results)
 
-    model_results = None
     model_results_file_path =model_results_path
 
     if model_results_path.is_dir():
         json_files = find_json_files(model_results_path)
         model_results_file = [file for file in json_files if args.task in file and "metrics" not in file][0]
-        model_results = read_json(model_results_file)
         model_results_file_path = pathlib.Path(model_results_file)
-    else:
-        model_results = read_json(args.model_results)
+
+    model_results = read_model_results(model_results_file_path)
+
+    if model_results is None:
+        raise ValueError(f"{model_results_file_path} has no correctness of its samples to test.")
     
     human_results = read_json(args.human_results)
 
-    model_results_map = {}
-
     data = {"model": [], "human": []}
-    task_info = TASK_MAP[args.task]
-
-    for result in model_results["data"]:
-        model_results_map[result[task_info["model_id_attr"]]] = result
+    model_results_map = get_model_results_map(model_results["data"], args.task)
 
     for human_result in human_results:
-        human_id = human_result[task_info["human_id_attr"]]
+        instance_id = match_human_result(human_result, model_results_map, args.task)
 
-        if args.task in ["mt_zh_en", "mt_en_de", "mt_en_fr", "mt_en_ru"]:
-            human_id = human_result[task_info["human_id_attr"]] + "-" + str(human_result["label"])
-        
-        if human_id in model_results_map:
-            model_result = model_results_map[human_id]
-            data["model"].append("correct" if model_result["correct"] else "incorrect")
+        if instance_id is not None:
+            data["model"].append("correct" if model_results_map[instance_id]["correct"] else "incorrect")
             data["human"].append("correct" if human_result["correct"] else "incorrect")
-        elif args.task == "intent":
-            for i in range(10):
-                human_id = f'{human_result["data_id"]}-intent-{i}'
-                if human_id in model_results_map:
-                    model_result = model_results_map[human_id]
-                    if human_result["label"] == model_result["intent"]["label"] and human_result["intent"] == model_result["intent"]["text"]:
-                        data["model"].append("correct" if model_result["correct"] else "incorrect")
-                        data["human"].append("correct" if human_result["correct"] else "incorrect")
-                        break
-        else:
-            # for result in model_results["data"]:
-            #     if "model_target_subattr" in task and isinstance(task["model_target_subattr"], list):
-            #         for m_tgt_attr, h_tgt_attr in zip(task["model_target_subattr"], task["human_target_attr"]):
-            #             if human_result[h_tgt_attr] != result[m_tgt_attr]:
-            #                 break
-
-            #     if human_result["label"] == model_result[task["model_target_attr"]]["label"]:
-            #         human_result["intent"] == model_result["intent"]["text"]
-            print("Human ID {} not found in model results".format(human_id))
 
     df = pd.DataFrame(data) 
 
-    test_results = {}
-
-    if args.test == "mcnemar":
-        test_results = computer_mcnemar(df, args.sig_level)
-    elif args.test == "fisher":
-        test_results = compute_fisher_exact(df, args.sig_level)
-    elif args.test == "binomial":
-        test_results = compute_binomial_test(df, args.sig_level)
-    elif args.test == "pitman":
-        test_results = compute_pitman(df, args.sig_level)
-    else:
-        raise ValueError("Unknown test type: {}".format(args.test))
+    test_results = run_test(args.test, df, args.sig_level, sample_size=args.sample_size, seed=args.seed)
 
     output_dir = pathlib.Path(f"{args.output_dir}/{args.test}")
     output_dir.mkdir(parents=True, exist_ok=True)
@@ -296,4 +582,4 @@ def main():
     write_json(outputs, output_dir / f"{model_results_file_path.stem}_stat_test_{args.test}.json")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,111 @@
+import random
+from collections import defaultdict
+import numpy as np
+
+def stratified_group_order(data, seed=None, group_attr="data_id"):
+    """Shuffles samples so that each group stays contiguous and every prefix keeps roughly the label mix of the whole set."""
+    rng = random.Random(seed)
+    groups = defaultdict(list)
+
+    for sample in data:
+        groups[sample[group_attr]].append(sample)
+
+    strata = defaultdict(list)
+
+    for group_id, samples in groups.items():
+        num_positive = sum(1 for sample in samples if sample["answer"].strip().lower() == "yes")
+        strata[(len(samples), num_positive)].append(group_id)
+
+    ranked_groups = []
+
+    # interleave the strata by giving every group a rank proportional to its position within its stratum
+    for group_ids in strata.values():
+        rng.shuffle(group_ids)
+
+        for rank, group_id in enumerate(group_ids):
+            ranked_groups.append(((rank + rng.random()) / len(group_ids), group_id))
+
+    ranked_groups.sort()
+
+    return [sample for _, group_id in ranked_groups for sample in groups[group_id]]
+
+def macro_f1_from_counts(tp, fp, fn, tn):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        positive_f1 = np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 0)
+        negative_f1 = np.where(2 * tn + fp + fn > 0, 2 * tn / (2 * tn + fp + fn), 0)
+
+    return (positive_f1 + negative_f1) / 2
+
+class SequentialStopper():
+    """Tracks a running macro-F1 estimate over whole groups and signals when its bootstrap confidence interval is tight enough."""
+
+    def __init__(self, group_sizes, half_width, confidence=0.95, min_groups=30, check_every=25, num_resamples=1000, seed=None):
+        self.group_sizes = group_sizes
+        self.target_half_width = half_width
+        self.confidence = confidence
+        self.min_groups = min_groups
+        self.check_every = check_every
+        self.num_resamples = num_resamples
+        self.rng = np.random.default_rng(seed)
+        self.group_results = defaultdict(list)
+        self.completed_groups = []
+        self.num_instances = 0
+        self.estimate = None
+        self.interval = None
+        self.stopped = False
+
+    def add(self, group_id, ref, pred):
+        self.group_results[group_id].append((ref, pred))
+        self.num_instances += 1
+
+        if len(self.group_results[group_id]) == self.group_sizes[group_id]:
+            self.completed_groups.append(group_id)
+
+            if len(self.completed_groups) >= self.min_groups and len(self.completed_groups) % self.check_every == 0:
+                self.update()
+                self.stopped = (self.interval[1] - self.interval[0]) / 2 <= self.target_half_width
+
+    def get_group_counts(self):
+        counts = np.zeros((len(self.completed_groups), 5))
+
+        for index, group_id in enumerate(self.completed_groups):
+            results = np.array(self.group_results[group_id])
+            refs, preds = results[:, 0], results[:, 1]
+            counts[index] = [
+                np.sum((refs == 1) & (preds == 1)),
+                np.sum((refs == 0) & (preds == 1)),
+                np.sum((refs == 1) & (preds == 0)),
+                np.sum((refs == 0) & (preds == 0)),
+                np.all(refs == preds)
+            ]
+
+        return counts
+
+    def update(self):
+        counts = self.get_group_counts()
+        self.estimate = {
+            "macro_f1": float(macro_f1_from_counts(*counts[:, :4].sum(axis=0))),
+            "exact_match": float(counts[:, 4].mean())
+        }
+
+        # resample whole groups so that exact-match groups are never split
+        resample_indices = self.rng.integers(0, len(counts), size=(self.num_resamples, len(counts)))
+        resampled_counts = counts[resample_indices].sum(axis=1)
+        resampled_f1 = macro_f1_from_counts(*resampled_counts[:, :4].T)
+        alpha = (1 - self.confidence) / 2
+        self.interval = [float(np.quantile(resampled_f1, alpha)), float(np.quantile(resampled_f1, 1 - alpha))]
+
+    def stats(self):
+        if self.completed_groups:
+            self.update()
+
+        return {
+            "target_half_width": self.target_half_width,
+            "confidence": self.confidence,
+            "stopped_early": self.stopped,
+            "num_instances": self.num_instances,
+            "num_groups": len(self.completed_groups),
+            "estimate": self.estimate,
+            "interval": self.interval,
+            "half_width": (self.interval[1] - self.interval[0]) / 2 if self.interval is not None else None
+        }
@@ -0,0 +1,74 @@
+import os
+import shutil
+import hashlib
+import time
+from datasets import Dataset, load_from_disk
+
+TOKEN_CACHE_DIR = os.path.expanduser("~/.cache/crow/tokens")
+
+def hash_file(path, chunk_size=1024 ** 2):
+    sha = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def get_token_cache_path(datapath, tokenizer_name, cache_dir):
+    # an edited eval file or another tokenizer gets a new entry, so stale ids are never loaded
+    key = hashlib.sha256(f"{hash_file(datapath)}:{tokenizer_name}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, key)
+
+def tokenize_prompts(batch, tokenizer):
+    input_ids = tokenizer(batch["prompt"])["input_ids"]
+    return {"input_ids": input_ids, "length": [len(ids) for ids in input_ids]}
+
+def build_token_cache(instance_ids, prompts, tokenizer, output_dir, num_proc=1):
+    start = time.perf_counter()
+    tmp_dir = output_dir + f".tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    dataset = Dataset.from_dict({"instance_id": instance_ids, "prompt": prompts})
+    num_proc = min(num_proc, len(prompts))
+    dataset = dataset.map(tokenize_prompts, batched=True, fn_kwargs={"tokenizer": tokenizer}, remove_columns=["prompt"], num_proc=num_proc if num_proc > 1 else None, desc="Tokenizing prompts")
+    dataset.save_to_disk(tmp_dir)
+
+    try:
+        os.rename(tmp_dir, output_dir)
+    except OSError:
+        # another process finished the same cache first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        if not os.path.isdir(output_dir):
+            raise
+
+    print(f"Tokenized {len(prompts)} prompts to {output_dir} in {time.perf_counter() - start:.1f}s")
+
+class TokenCache():
+    """Input ids and lengths of the prompts of a prepared eval file, memory-mapped from an Arrow cache."""
+
+    def __init__(self, path):
+        self.path = path
+        # load_from_disk maps the Arrow files, so rows are only paged in when a batch reads them
+        self.dataset = load_from_disk(path)
+        self.rows = {instance_id: row for row, instance_id in enumerate(self.dataset["instance_id"])}
+
+    def __contains__(self, instance_id):
+        return instance_id in self.rows
+
+    def get_lengths(self, instance_ids):
+        return self.dataset[[self.rows[instance_id] for instance_id in instance_ids]]["length"] if instance_ids else []
+
+    def get_input_ids(self, instance_ids):
+        return self.dataset[[self.rows[instance_id] for instance_id in instance_ids]]["input_ids"] if instance_ids else []
+
+def get_token_cache(datapath, instance_ids, prompts, tokenizer, tokenizer_name, cache_dir=TOKEN_CACHE_DIR, num_proc=1):
+    """Returns the token cache of an eval file for a tokenizer, tokenizing its prompts with num_proc processes once."""
+    path = get_token_cache_path(datapath, tokenizer_name, cache_dir)
+
+    if not os.path.isdir(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        build_token_cache(instance_ids, prompts, tokenizer, path, num_proc=num_proc)
+
+    return TokenCache(path)
@@ -0,0 +1,91 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import time
+import torch
+from safetensors.torch import save_file
+
+WEIGHTS_CACHE_DIR = os.path.expanduser("~/.cache/crow/safetensors")
+
+def get_legacy_weights(checkpoint_dir):
+    return sorted(glob.glob(os.path.join(checkpoint_dir, "pytorch_model*.bin")))
+
+def get_weights_cache_path(checkpoint_dir, weights_files, cache_dir):
+    # a new or rewritten checkpoint gets a new entry, so stale conversions are never loaded
+    mtime = max(os.path.getmtime(path) for path in weights_files)
+    key = hashlib.sha256(f"{os.path.abspath(checkpoint_dir)}:{mtime}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, key)
+
+def unshare_tensors(state_dict):
+    # safetensors refuses tensors sharing storage, like tied embeddings, so later ones get their own copy
+    storages = set()
+    tensors = {}
+
+    for name, tensor in state_dict.items():
+        storage = tensor.untyped_storage().data_ptr()
+        tensors[name] = tensor.clone().contiguous() if storage in storages else tensor.contiguous()
+        storages.add(storage)
+
+    return tensors
+
+def convert_to_safetensors(checkpoint_dir, weights_files, output_dir):
+    start = time.perf_counter()
+    tmp_dir = output_dir + f".tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    # configs and tokenizer files are copied so that the converted directory loads on its own
+    for path in glob.glob(os.path.join(checkpoint_dir, "*")):
+        if os.path.isfile(path) and not os.path.basename(path).startswith("pytorch_model"):
+            shutil.copy(path, tmp_dir)
+
+    file_map = {}
+
+    for index, path in enumerate(weights_files):
+        file_name = "model.safetensors" if len(weights_files) == 1 else f"model-{index + 1:05d}-of-{len(weights_files):05d}.safetensors"
+        state_dict = torch.load(path, map_location="cpu", weights_only=True)
+        save_file(unshare_tensors(state_dict), os.path.join(tmp_dir, file_name), metadata={"format": "pt"})
+        file_map[os.path.basename(path)] = file_name
+        del state_dict
+
+    legacy_index_path = os.path.join(checkpoint_dir, "pytorch_model.bin.index.json")
+
+    if os.path.exists(legacy_index_path):
+        with open(legacy_index_path, "r") as f:
+            index = json.load(f)
+
+        index["weight_map"] = {name: file_map[file_name] for name, file_name in index["weight_map"].items()}
+
+        with open(os.path.join(tmp_dir, "model.safetensors.index.json"), "w") as f:
+            json.dump(index, f, indent=4)
+
+    try:
+        os.rename(tmp_dir, output_dir)
+    except OSError:
+        # another process finished the same conversion first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        if not os.path.isdir(output_dir):
+            raise
+
+    print(f"Converted {checkpoint_dir} to safetensors in {output_dir} in {time.perf_counter() - start:.1f}s")
+
+def resolve_checkpoint(checkpoint, cache_dir=WEIGHTS_CACHE_DIR):
+    """Returns a checkpoint that loads with memory-mapped safetensors, converting local .bin checkpoints once."""
+    if cache_dir is None or not os.path.isdir(checkpoint) or glob.glob(os.path.join(checkpoint, "*.safetensors")):
+        return checkpoint
+
+    weights_files = get_legacy_weights(checkpoint)
+
+    if not weights_files:
+        return checkpoint
+
+    cache_path = get_weights_cache_path(checkpoint, weights_files, cache_dir)
+
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        convert_to_safetensors(checkpoint, weights_files, cache_path)
+
+    return cache_path
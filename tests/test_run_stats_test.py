@@ -0,0 +1,66 @@
+import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "evaluation"))
+
+import run_stats_test
+
+NUM_INSTANCES = 40
+
+def write_results(path, metadata, samples):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({"metadata": metadata, "data": samples}))
+
+def make_samples(correct_key, accuracy):
+    return [{"instance_id": f"s{i}", "type": "bcq", correct_key: i % 10 < accuracy * 10} for i in range(NUM_INSTANCES)]
+
+def make_outputs(tmp_path):
+    outputs = tmp_path / "outputs"
+    write_results(outputs / "gpt-4" / "run1" / "safety_eval_llm_bcq_gpt-4_a1.json", {"model": "gpt-4", "temperature": 0.3}, make_samples("correct", 0.8))
+    # evaluate_hf stores the correctness of each answering method
+    write_results(outputs / "llama7" / "run1" / "safety_eval_llm_bcq_llama7_b2.json", {"model": "llama7", "generate": False}, make_samples("correct_highest_proba", 0.5))
+    write_results(outputs / "llama13" / "run1" / "safety_eval_llm_bcq_llama13_c3.json", {"model": "llama13", "generate": True}, make_samples("correct_generated_output", 0.6))
+    # one run directory with two templates of the same task
+    write_results(outputs / "vicuna" / "run1" / "safety_eval_llm_bcq_vicuna_d4.json", {"model": "vicuna", "generate": False}, make_samples("correct_highest_proba", 0.7))
+    write_results(outputs / "vicuna" / "run1" / "safety_eval_llm_bcq_cot_vicuna_e5.json", {"model": "vicuna", "generate": True}, make_samples("correct_generated_output", 0.4))
+    # mcq results are scored per option and have no correctness per instance
+    write_results(outputs / "alpaca" / "run1" / "safety_eval_llm_mcq_alpaca_f6.json", {"model": "alpaca", "generate": False}, [{"instance_id": "s0", "type": "mcq", "accuracy": 1.0}])
+    (outputs / "gpt-4" / "run1" / "safety_eval_llm_bcq_gpt-4_a1_metrics.json").write_text(json.dumps({"macro_f1": 0.5}))
+
+    human = tmp_path / "human"
+    human.mkdir()
+    (human / "safety_human.json").write_text(json.dumps([{"action_id": f"s{i}", "correct": i % 10 < 9} for i in range(NUM_INSTANCES)]))
+    return outputs, human
+
+def test_all_pairs_reads_gpt_and_hf_runs(tmp_path):
+    outputs, human = make_outputs(tmp_path)
+
+    matrix = run_stats_test.run_all_pairs(outputs, human, ["safety"], ["mcnemar", "binomial"], num_workers=1, sample_size=100)
+    participants = matrix["tasks"]["safety"]["participants"]
+
+    assert participants == [
+        "gpt-4/run1",
+        "llama13/run1",
+        "llama7/run1",
+        "vicuna/run1/safety_eval_llm_bcq_cot_vicuna_e5",
+        "vicuna/run1/safety_eval_llm_bcq_vicuna_d4",
+        "human",
+    ]
+
+    accuracies = {pair["first"]: pair["first_accuracy"] for pair in matrix["pairs"] if pair["second"] == "human"}
+    assert accuracies["gpt-4/run1"] == 0.8
+    assert accuracies["llama7/run1"] == 0.5
+    assert accuracies["llama13/run1"] == 0.6
+
+    # 5 model x human pairs and 10 model x model pairs
+    assert len(matrix["pairs"]) == 15
+    assert all(pair["n"] == NUM_INSTANCES for pair in matrix["pairs"])
+
+def test_read_model_results_uses_the_method_of_the_run(tmp_path):
+    outputs, _ = make_outputs(tmp_path)
+
+    hf_results = run_stats_test.read_model_results(outputs / "llama13" / "run1" / "safety_eval_llm_bcq_llama13_c3.json")
+    assert [sample["correct"] for sample in hf_results["data"]] == [sample["correct_generated_output"] for sample in hf_results["data"]]
+    assert run_stats_test.read_model_results(outputs / "alpaca" / "run1" / "safety_eval_llm_mcq_alpaca_f6.json") is None
@@ -17,6 +17,7 @@ import math
 import uuid
 import tiktoken
 import numbers
+import functools
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
@@ -102,18 +103,34 @@ MODEL_COSTS = {
     "text-davinci-003": {'input': 0.00002, 'output': 0.00002},
 }
 
+MODEL_RATE_LIMITS = {
+    "gpt-3.5-turbo": {'rpm': 3500, 'tpm': 90000},
+    "gpt-4": {'rpm': 200, 'tpm': 40000},
+    "text-davinci-003": {'rpm': 3000, 'tpm': 250000},
+}
+
 MODEL_ENCODINGS = {
     "gpt-3.5-turbo": "cl100k_base",
     "gpt-4": "cl100k_base",
     "text-davinci-003": "p50k_base"
 }
 
+# entries of _metrics.json files that describe the metrics instead of being averaged with them
+NON_METRIC_KEYS = ["content_hash", "ci"]
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name):
+    return tiktoken.get_encoding(encoding_name)
+
 def num_tokens_from_string(text, model):
-    encoding_name = MODEL_ENCODINGS[model]
-    encoding = tiktoken.get_encoding(encoding_name)
+    encoding = get_encoding(MODEL_ENCODINGS[model])
     num_tokens = len(encoding.encode(text))
     return num_tokens
 
+def num_tokens_from_strings(texts, model, num_threads=8):
+    encoding = get_encoding(MODEL_ENCODINGS[model])
+    return [len(tokens) for tokens in encoding.encode_batch(texts, num_threads=num_threads)]
+
 def read_json(path):
     with open(path, "r") as f:
         data = json.load(f)
@@ -135,66 +152,96 @@ def chat_completion(messages, model="gpt-3.5-turbo", return_text=False):
             time.sleep(60)
             continue
 
-@torch.no_grad()
-def score_decoder(text, model, tokenizer, device=torch.device("cpu")):
-    input_ids = tokenizer.encode(text, return_tensors="pt")
-    input_logprobs = []
-    logits = model(input_ids.to(device)).logits
-    all_logprobs = torch.log_softmax(logits.double(), dim=2)
+def get_decoder_batch(pairs, tokenizer):
+    sequences = []
+    target_starts = []
 
-    for k in range(input_ids.shape[1]):
-        input_logprobs.append(all_logprobs[0, k-1, input_ids[0, k]].cpu())
+    for context, text in pairs:
+        context_ids = tokenizer.encode(context) if context else []
+        text_ids = tokenizer.encode(text, add_special_tokens=False)
 
-    score = np.mean(input_logprobs)
+        # without a context the first token has nothing to be predicted from, unless the tokenizer has a bos token
+        if not context_ids and tokenizer.bos_token_id is not None:
+            context_ids = [tokenizer.bos_token_id]
 
-    return score.item()
+        sequences.append(context_ids + text_ids)
+        target_starts.append(max(len(context_ids), 1))
+
+    max_length = max(len(sequence) for sequence in sequences)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    input_ids = torch.full((len(sequences), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_length), dtype=torch.long)
+    target_mask = torch.zeros((len(sequences), max_length), dtype=torch.bool)
+
+    for index, (sequence, target_start) in enumerate(zip(sequences, target_starts)):
+        input_ids[index, :len(sequence)] = torch.tensor(sequence, dtype=torch.long)
+        attention_mask[index, :len(sequence)] = 1
+        target_mask[index, target_start:len(sequence)] = True
+
+    # logits at position k predict the token at position k + 1
+    return {"input_ids": input_ids, "attention_mask": attention_mask}, input_ids[:, 1:], target_mask[:, 1:]
+
+def get_encoder_decoder_batch(pairs, model, tokenizer):
+    inputs = tokenizer([context for context, _ in pairs], return_tensors="pt", padding=True)
+    labels = [tokenizer.encode(text) for _, text in pairs]
+    max_length = max(len(label_ids) for label_ids in labels)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    decoder_input_ids = torch.full((len(pairs), max_length), pad_token_id, dtype=torch.long)
+    target_ids = torch.full((len(pairs), max_length), pad_token_id, dtype=torch.long)
+    target_mask = torch.zeros((len(pairs), max_length), dtype=torch.bool)
+
+    for index, label_ids in enumerate(labels):
+        # decoder inputs are the labels shifted right behind the start token
+        decoder_input_ids[index, :len(label_ids)] = torch.tensor([model.config.decoder_start_token_id] + label_ids[:-1], dtype=torch.long)
+        target_ids[index, :len(label_ids)] = torch.tensor(label_ids, dtype=torch.long)
+        target_mask[index, :len(label_ids)] = True
+
+    return {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"], "decoder_input_ids": decoder_input_ids}, target_ids, target_mask
 
 @torch.no_grad()
-def score_encoder_decoder(context, text, model, tokenizer, device=torch.device("cpu")):
-    context_ids = tokenizer.encode(context, return_tensors="pt")
-    text_ids = tokenizer.encode(text, return_tensors="pt")
-    text_logprobs = []
-    logits = model(input_ids=context_ids.to(device), decoder_input_ids=text_ids.to(device)).logits
-    all_logprobs = torch.log_softmax(logits.double(), dim=2)
+def score_sequences(pairs, model, tokenizer, device=torch.device("cpu"), batch_size=8):
+    """Teacher-forced log-likelihood of every text given its context, for a list of (context, text) pairs.
 
-    for k in range(text_ids.shape[1]):
-        text_logprobs.append(all_logprobs[0, k-1, text_ids[0, k]].cpu())
+    Returns one dict per pair with the mean and sum of the log-probabilities of the scored text tokens.
+    """
+    scores = [None] * len(pairs)
+    # pairs of similar length are batched together to limit padding
+    order = sorted(range(len(pairs)), key=lambda index: len(pairs[index][0]) + len(pairs[index][1]))
 
-    score = np.mean(text_logprobs)
+    for batch_indices in chunk(order, batch_size):
+        batch_pairs = [pairs[index] for index in batch_indices]
 
-    return score.item()
+        if model.config.is_encoder_decoder:
+            inputs, target_ids, target_mask = get_encoder_decoder_batch(batch_pairs, model, tokenizer)
+            logits = model(**{name: tensor.to(device) for name, tensor in inputs.items()}).logits
+        else:
+            inputs, target_ids, target_mask = get_decoder_batch(batch_pairs, tokenizer)
+            logits = model(**{name: tensor.to(device) for name, tensor in inputs.items()}).logits[:, :-1]
 
-def score_with_generation(context, text, model, tokenizer, device=torch.device("cpu")):
-    input_ids = tokenizer.encode(context, return_tensors="pt")
-    text_ids =  tokenizer.encode(text, return_tensors="pt")
-    text_logprobs = []
-
-    for text_id in text_ids[0]:
-        output = model.generate(input_ids.to(device), max_new_tokens=1, pad_token_id=tokenizer.eos_token_id, output_scores=True, return_dict_in_generate=1)
-        probs = output.scores[0].log_softmax(dim=-1).squeeze()
-        text_logprobs.append(probs[text_id].cpu())
-        input_ids = torch.cat([input_ids, text_id.reshape(1, 1)], dim=-1)
-    
-    score = np.mean(text_logprobs)
+        logits = logits.float()
+        target_ids = target_ids.to(logits.device)
+        target_mask = target_mask.to(logits.device)
+        target_logprobs = logits.gather(-1, target_ids.unsqueeze(-1)).squeeze(-1) - torch.logsumexp(logits, dim=-1)
+        target_logprobs = target_logprobs.masked_fill(~target_mask, 0)
+        sums = target_logprobs.sum(dim=-1).tolist()
+        counts = target_mask.sum(dim=-1).tolist()
 
-    return score.item()
+        for index, logprob_sum, count in zip(batch_indices, sums, counts):
+            scores[index] = {"mean": logprob_sum / count if count > 0 else float("nan"), "sum": logprob_sum, "num_tokens": count}
 
-def score_with_generation_enc_dec(context, text, model, tokenizer, device=torch.device("cpu")):
-    context_ids = tokenizer.encode(context, return_tensors="pt")
-    text_ids = tokenizer.encode(text, return_tensors="pt")[0].tolist()
-    text_ids = [text_id for text_id in text_ids if text_id != model.config.bos_token_id]
-    text_logprobs = []
-
-    for index in range(1, len(text_ids)):
-        forced_decoder_ids = list(zip(range(1, index+1), text_ids[:index]))
-        output = model.generate(context_ids.to(device), max_new_tokens=index+2, output_scores=True, return_dict_in_generate=True, num_beams=1, forced_decoder_ids=forced_decoder_ids)
-        probs = output.scores[-2].log_softmax(dim=-1).squeeze()
-        next_id = text_ids[index]
-        text_logprobs.append(probs[next_id].item())
-    
-    score = np.mean(text_logprobs)
+    return scores
+
+def score_decoder(text, model, tokenizer, device=torch.device("cpu")):
+    return score_sequences([("", text)], model, tokenizer, device=device)[0]["mean"]
+
+def score_encoder_decoder(context, text, model, tokenizer, device=torch.device("cpu")):
+    return score_sequences([(context, text)], model, tokenizer, device=device)[0]["mean"]
 
-    return score
+def score_with_generation(context, text, model, tokenizer, device=torch.device("cpu")):
+    return score_sequences([(context, text)], model, tokenizer, device=device)[0]["mean"]
+
+def score_with_generation_enc_dec(context, text, model, tokenizer, device=torch.device("cpu")):
+    return score_sequences([(context, text)], model, tokenizer, device=device)[0]["mean"]
 
 def clean(text, replace_emoji=True):
     text = text.strip().replace(' .', '.').replace(' ?', '?').replace(' ,', ',').replace(' !', '!')
@@ -620,7 +667,9 @@ def get_avg_metrics_from_dicts(lst_of_dicts):
     avg_metrics = {}
 
     for key, val in metrics.items():
-        if isinstance(val, numbers.Number):
+        if key in NON_METRIC_KEYS:
+            continue
+        elif isinstance(val, numbers.Number):
             metric_names.append(key)
         elif isinstance(val, dict):
             for subkey, subval in val.items():